@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pose_cache import file_hash
+from s3_download import download_s3_file, redact_url
+from storage import S3_BUCKET_NAME, download_file, is_missing, object_exists, object_url, upload_file
+from workspace import Workspace
+
+
+# Every analysis is stored under ARTIFACT_PREFIX/<analysis id>/ in the bucket:
+#   result.json     kind, request parameters, source videos and scores
+#   landmarks.npz   the pose landmarks of both videos
+#   video_*.mp4     renders, one per encoding, made on demand
+# The angle series are derived from the landmarks, so they aren't stored.
+# The source videos are copied to ARTIFACT_PREFIX/sources/<sha256>.mp4, shared
+# by every analysis of the same video: the URLs they came from (stored without
+# their query string, which holds the signature of presigned URLs) expire.
+PERSIST_ANALYSES = os.environ.get("PERSIST_ANALYSES", "1") == "1"
+ARTIFACT_PREFIX = os.environ.get("ARTIFACT_PREFIX", "analyses")
+# 2: sources carry the bucket key of their copy
+ARTIFACT_VERSION = 2
+
+# Uploads of analyses saved with background=True. Its threads are joined when
+# the worker process exits, so pending uploads finish on shutdown.
+_background_uploads = None
+
+
+class AnalysisNotFound(KeyError):
+    """Raised when no stored analysis has the requested id"""
+
+
+def artifact_key(analysis_id, name):
+    if not re.fullmatch(r"[0-9a-f]{32}", analysis_id or ""):
+        raise AnalysisNotFound(analysis_id)
+    return f"{ARTIFACT_PREFIX}/{analysis_id}/{name}"
+
+
+def source_key(content_hash):
+    return f"{ARTIFACT_PREFIX}/sources/{content_hash}.mp4"
+
+
+def save_analysis(kind, downloads, landmarks, params, result, workspace, content_hashes=None, background=False):
+    """
+    Store an analysis so it can be rendered later without running pose
+    inference again. downloads are the (url, local path) pairs of the
+    correct and wrong videos, landmarks their landmark arrays and
+    content_hashes, when known, their files' hashes. Returns the analysis
+    id, or None when persistence is off or the upload fails.
+
+    With background=True the upload runs on a background thread and the id
+    is returned straight away: the analysis can't be loaded until the upload
+    has finished (load_record raises AnalysisNotFound), and if it fails the
+    id never becomes valid.
+    """
+    if not PERSIST_ANALYSES or not S3_BUCKET_NAME:
+        return None
+
+    analysis_id = uuid.uuid4().hex
+    record = {
+        "version": ARTIFACT_VERSION,
+        "analysis_id": analysis_id,
+        "kind": kind,
+        "created_at": time.time(),
+        "params": params,
+        "sources": [],
+        "result": result,
+    }
+    for (url, path), content_hash in zip(downloads, content_hashes or [None] * len(downloads)):
+        content_hash = content_hash or file_hash(path)
+        record["sources"].append({"url": redact_url(url), "sha256": content_hash, "key": source_key(content_hash)})
+    paths = [path for _, path in downloads]
+
+    if background:
+        global _background_uploads
+        if _background_uploads is None:
+            _background_uploads = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artifact-upload")
+        # The job's workspace is removed when the request finishes, so the
+        # upload keeps the source videos in a workspace of its own
+        own = Workspace("artifact").__enter__()
+        try:
+            paths = [_keep(path, own.path("source", f"{index}.mp4")) for index, path in enumerate(paths)]
+        except OSError as e:
+            own.cleanup()
+            print(f"Could not store analysis {analysis_id}: {e}")
+            return None
+        _background_uploads.submit(_upload_and_clean_up, record, landmarks, paths, own)
+        return analysis_id
+    return analysis_id if _upload(record, landmarks, paths, workspace) else None
+
+
+def _keep(path, target):
+    """Hard link path to target (a copy across file systems) and return target"""
+    try:
+        os.link(path, target)
+    except OSError:
+        shutil.copyfile(path, target)
+    return target
+
+
+def _upload_and_clean_up(record, landmarks, paths, workspace):
+    try:
+        _upload(record, landmarks, paths, workspace)
+    finally:
+        workspace.cleanup()
+
+
+def _upload(record, landmarks, paths, workspace):
+    """Upload an analysis' source videos, landmarks and result.json; returns whether it worked"""
+    analysis_id = record["analysis_id"]
+    try:
+        # A reference clip compared against many submissions is uploaded once
+        for source, path in zip(record["sources"], paths):
+            if not object_exists(source["key"]):
+                upload_file(path, source["key"])
+
+        landmarks_path = workspace.path("artifact", "landmarks.npz")
+        np.savez_compressed(landmarks_path, correct=landmarks[0], wrong=landmarks[1])
+        upload_file(landmarks_path, artifact_key(analysis_id, "landmarks.npz"))
+
+        # Written last: an analysis only exists once its result.json does
+        record_path = workspace.path("artifact", "result.json")
+        with open(record_path, "w") as f:
+            json.dump(record, f)
+        upload_file(record_path, artifact_key(analysis_id, "result.json"))
+    except Exception as e:
+        print(f"Could not store analysis {analysis_id}: {e}")
+        return False
+    return True
+
+
+def _download(analysis_id, name, path):
+    from botocore.exceptions import ClientError
+    try:
+        download_file(artifact_key(analysis_id, name), path)
+    except ClientError as e:
+        if is_missing(e):
+            raise AnalysisNotFound(analysis_id)
+        raise
+
+
+def load_record(analysis_id, workspace):
+    """The stored result.json of an analysis"""
+    path = workspace.path("artifact", "result.json")
+    _download(analysis_id, "result.json", path)
+    with open(path) as f:
+        return json.load(f)
+
+
+def download_source(source, path):
+    """Fetch one of the "sources" of a stored analysis to path; returns whether it worked"""
+    if "key" not in source:
+        # Stored before the sources were copied to the bucket: only the URL is left
+        return download_s3_file(source["url"], path)
+    try:
+        download_file(source["key"], path)
+    except Exception as e:
+        print(f"Could not download source video {source['key']}: {e}")
+        return False
+    return True
+
+
+def load_landmarks(analysis_id, workspace):
+    """The (correct, wrong) landmark arrays of an analysis"""
+    path = workspace.path("artifact", "landmarks.npz")
+    _download(analysis_id, "landmarks.npz", path)
+    with np.load(path) as data:
+        return data["correct"], data["wrong"]
+
+
+def render_key(analysis_id, encoding):
+    """Key of an analysis' render with the given encoder settings"""
+    digest = hashlib.sha256(json.dumps(encoding, sort_keys=True).encode()).hexdigest()[:16]
+    return artifact_key(analysis_id, f"video_{encoding['profile']}_{digest}.mp4")
+
+
+def cached_render(analysis_id, encoding):
+    """URL of an existing render of the analysis with these settings, or None"""
+    key = render_key(analysis_id, encoding)
+    return object_url(key) if object_exists(key) else None
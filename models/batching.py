@@ -0,0 +1,56 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent single-item calls into batched calls.
+
+    submit(item) queues the item and waits. The queue is flushed when it holds
+    max_batch items or `window` seconds after the first item arrived, and
+    fn(items) is then called once on a dedicated worker thread. fn must return
+    one result per item, in order. Batches run one at a time, so items that
+    arrive while a batch is running are collected into the next one.
+    """
+
+    def __init__(self, fn, max_batch=32, window=0.01):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.window = window
+        self.pending = []
+        self.flush_handle = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    async def submit_many(self, items):
+        return await asyncio.gather(*(self.submit(item) for item in items))
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.fn, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,368 @@
+"""
+End-to-end timings of the three comparison pipelines and of injury inference.
+
+Run from the models directory:
+    python -m benchmarks.end_to_end
+    python -m benchmarks.end_to_end --sizes 640x360 1280x720 --fps 30 --durations 5 20 --output before.json
+    python -m benchmarks.end_to_end --output after.json --compare before.json
+    python -m benchmarks.end_to_end --pipelines ball_handling --videos correct.mp4 wrong.mp4
+
+Every case runs offline. The videos are the app's sample clips of a real
+player (SAMPLE_VIDEOS), resampled to each combination of --sizes, --fps and
+--durations (letterboxed, looped when the clip is shorter) and written as
+fragmented MP4s, or the clips given with --videos as they are. They are
+served over HTTP from a local server and go through the workers' ingest
+path: streaming download with pose extraction (see streaming_ingest.py),
+then the landmark lookup and the analysis. Injury cases use synthetic
+images. S3 uploads go to an in-process stub (optionally limited to
+--upload-mbps). Each case runs in a fresh process, with pose estimators and
+the injury model loaded before timing starts (as the job workers do) and an
+empty landmark cache, so nothing carries over between cases.
+
+For each case the report gives the wall time, input frames per second, the
+time spent in each stage recorded by timing.stage() (download, decode, pose,
+angles, graph, annotate, composite, encode, upload for the videos; decode
+and inference for images), the peak RSS of the process and of its largest child
+(the ffmpeg encoder), the share of frames of each video in which MediaPipe
+found a pose, and the scores, so a change that makes a pipeline faster but
+different shows up too.
+Stages running in parallel threads are summed and can exceed the wall time.
+
+Timings are only meaningful when the pose stages actually run: a case in
+which either video has a pose in fewer than --min-detected of its frames
+is marked as an error, and the benchmark exits with status 1 when any case
+failed.
+
+--output saves the results as JSON, and --compare prints how each case
+changed against results saved earlier (e.g. on another commit).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import storage
+from attack_analysis import analyze_movement
+from ball_handling import create_combined_visualization
+from defence import analyze_defensive_movement
+from encoding import encoder_settings
+from inference import INFERENCE_MODES
+from kinematics import pose_mask
+from pose_extraction import extract_landmarks_pair, landmark_cache, warm_up
+from scoring import SCORING_METHODS
+from storage import video_upload
+from streaming_ingest import ingest_videos
+from timing import record_stages
+from video_io import VideoEncoder, fit_to_canvas, get_video_properties, read_frames
+from workspace import Workspace
+
+
+PIPELINES = {
+    "attack": analyze_movement,
+    "defence": analyze_defensive_movement,
+    "ball_handling": create_combined_visualization,
+}
+
+# Real clips of one player (from the frontend), in which MediaPipe finds a
+# pose in every frame; resampled into the benchmark's inputs
+SAMPLE_VIDEOS = [os.path.join(os.path.dirname(__file__), "..", "..", "frontend", "app", "assets", "videos", name)
+                 for name in ("correct.mp4", "wrong.mp4")]
+
+
+class StubS3Client:
+    """Accepts the calls storage makes and throws the data away, at mbps when given"""
+
+    def __init__(self, mbps=None):
+        self.mbps = mbps
+        self.bytes_uploaded = 0
+
+    def _send(self, size):
+        if self.mbps:
+            time.sleep(size * 8 / (self.mbps * 1e6))
+        self.bytes_uploaded += size
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "benchmark"}
+
+    def upload_part(self, Body, PartNumber, **kwargs):
+        self._send(len(Body))
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, **kwargs):
+        return {}
+
+    def abort_multipart_upload(self, **kwargs):
+        return {}
+
+    def upload_file(self, path, bucket, key, Config=None, Callback=None):
+        size = os.path.getsize(path)
+        self._send(size)
+        if Callback:
+            Callback(size)
+
+
+def sample_video(path, source, size, fps, seconds):
+    """
+    Write source resampled to size (letterboxed), fps and seconds, looping it
+    when it is shorter. The output is a fragmented MP4, so it can be decoded
+    while it downloads, as streaming ingest does with such uploads.
+    """
+    source_fps = get_video_properties(source)[2]
+    frames, position, frame = None, -1, None
+    with open(path, "wb") as output, VideoEncoder(output, size, fps, preset="veryfast", crf=18) as encoder:
+        for index in range(int(fps * seconds)):
+            # Decode up to the source frame shown at this time, starting over at the end
+            while position < int(index * source_fps / fps):
+                frame = next(frames, None) if frames is not None else None
+                if frame is None:
+                    frames = read_frames(source)
+                    frame = next(frames, None)
+                    if frame is None:
+                        raise ValueError(f"{source} has no frames")
+                position += 1
+            encoder.write(fit_to_canvas(frame, size))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_directory(directory):
+    """Serve directory over HTTP on a free local port for the duration of the run; returns its base URL"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), lambda *args: QuietHandler(*args, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def synthetic_image(path, size, seed):
+    """Write a deterministic skin-toned image with a few bruise-like blotches"""
+    width, height = size
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), (190, 150, 130), dtype=np.float32)
+    image += rng.normal(0, 12, image.shape)
+    for _ in range(rng.integers(2, 6)):
+        center = (int(rng.uniform(0, width)), int(rng.uniform(0, height)))
+        axes = (int(rng.uniform(0.05, 0.2) * width), int(rng.uniform(0.05, 0.2) * height))
+        blotch = np.zeros((height, width), dtype=np.float32)
+        cv2.ellipse(blotch, center, axes, rng.uniform(0, 180), 0, 360, 1.0, -1)
+        blotch = cv2.GaussianBlur(blotch, (0, 0), max(axes) / 3)[:, :, None]
+        image = image * (1 - 0.6 * blotch) + np.array(rng.choice([(120, 60, 110), (90, 70, 60), (160, 40, 40)])) * 0.6 * blotch
+    Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).save(path, quality=90)
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux; the largest child is normally the ffmpeg encoder
+    return (round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1))
+
+
+def run_video_case(case, correct_url, wrong_url):
+    """Ingest a pair of videos from their URLs and run one pipeline on them (in a fresh worker process)"""
+    analyze = PIPELINES[case["pipeline"]]
+    storage._s3_client = client = StubS3Client(case["upload_mbps"])
+    encoding = encoder_settings(case["profile"])
+
+    with Workspace("benchmark") as workspace:
+        landmark_cache.directory = workspace.subdir("landmarks")
+        start = time.perf_counter()
+        warm_up()
+        setup = time.perf_counter() - start
+
+        paths = [workspace.path("input", "correct_video.mp4"), workspace.path("input", "wrong_video.mp4")]
+        start = time.perf_counter()
+        # The steps of controller._run_pipeline, without the result cache and artifact storage
+        with record_stages() as timings:
+            hashes = ingest_videos(list(zip([correct_url, wrong_url], paths)), inference=case["inference"])
+            if not all(hashes):
+                raise RuntimeError("Could not download the input videos")
+            landmarks = extract_landmarks_pair(*paths, inference=case["inference"], content_hashes=hashes)
+            with video_upload(workspace, enabled=case["render"]) as upload:
+                result = analyze(*paths, upload.output if upload else None, scoring=case["scoring"],
+                                 inference=case["inference"], encoding=encoding, render=case["render"], landmarks=landmarks)
+        wall = time.perf_counter() - start
+
+    frames = sum(len(video) for video in landmarks)
+    peak_rss, children_rss = _peak_rss()
+    return {
+        **case,
+        "setup_s": round(setup, 3),
+        "wall_s": round(wall, 3),
+        "input_frames": frames,
+        "frames_per_second": round(frames / wall, 1),
+        # Share of each video's frames with a pose; the pose-dependent stages barely run without one
+        "detected": [round(float(np.mean(pose_mask(video))), 3) if len(video) else 0.0 for video in landmarks],
+        "stages": {name: round(entry["seconds"], 3) for name, entry in sorted(timings.stages.items())},
+        "events": timings.events,
+        "peak_rss_mb": peak_rss,
+        "children_peak_rss_mb": children_rss,
+        "output_mb": round(client.bytes_uploaded / 1024 / 1024, 2),
+        "scores": result.get("similarity_metrics") or {"right_elbow": result.get("similarity_value")},
+    }
+
+
+def run_injury_case(case, image_paths):
+    """Classify images one request at a time and then as one batch (in a fresh worker process)"""
+    from injury_detection import load_model, process_image, process_images
+
+    start = time.perf_counter()
+    load_model()
+    setup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with record_stages() as timings:
+        predictions = [process_image(path) for path in image_paths]
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with record_stages() as batch_timings:
+        process_images(image_paths)
+    batch = time.perf_counter() - start
+
+    peak_rss, _ = _peak_rss()
+    return {
+        **case,
+        "setup_s": round(setup, 3),
+        "wall_s": round(sequential, 3),
+        "images_per_second": round(len(image_paths) / sequential, 1),
+        "batch_wall_s": round(batch, 3),
+        "batch_images_per_second": round(len(image_paths) / batch, 1),
+        "stages": {name: round(entry["seconds"], 3) for name, entry in sorted(timings.stages.items())},
+        "batch_stages": {name: round(entry["seconds"], 3) for name, entry in sorted(batch_timings.stages.items())},
+        "peak_rss_mb": peak_rss,
+        "predictions": [prediction["class"] for prediction in predictions],
+    }
+
+
+def in_fresh_process(fn, *args):
+    """Run fn in a new spawned process, so peak RSS and caches belong to this case alone"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        try:
+            return executor.submit(fn, *args).result()
+        except Exception as e:
+            return {**args[0], "error": f"{type(e).__name__}: {e}"}
+
+
+def case_key(case):
+    return json.dumps({key: case.get(key) for key in ("pipeline", "size", "fps", "seconds", "videos", "images")}, sort_keys=True)
+
+
+def compare(results, baseline_path):
+    """Print each case's relative change against the results in baseline_path"""
+    with open(baseline_path) as f:
+        baseline = {case_key(case): case for case in json.load(f)["cases"]}
+    change = lambda new, old: round((new - old) / old * 100, 1) if new is not None and old else None
+    for case in results:
+        before = baseline.get(case_key(case))
+        if before is None or "error" in case or "error" in before:
+            continue
+        stages = set(case.get("stages", {})) | set(before.get("stages", {}))
+        print(json.dumps({
+            "compare": json.loads(case_key(case)),
+            "wall_pct": change(case["wall_s"], before["wall_s"]),
+            "peak_rss_pct": change(case["peak_rss_mb"], before["peak_rss_mb"]),
+            "stages_pct": {name: change(case["stages"].get(name), before["stages"].get(name)) for name in sorted(stages)},
+            "scores_changed": case.get("scores") != before.get("scores") or case.get("predictions") != before.get("predictions"),
+        }))
+
+
+def parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipelines", nargs="+", default=[*PIPELINES, "injury"], choices=[*PIPELINES, "injury"])
+    parser.add_argument("--sizes", nargs="+", default=[(640, 360), (1280, 720)], type=parse_size)
+    parser.add_argument("--fps", nargs="+", default=[30], type=int)
+    parser.add_argument("--durations", nargs="+", default=[5.0], type=float, help="Seconds of the correct clip; the wrong one is 10%% shorter")
+    parser.add_argument("--videos", nargs=2, metavar=("CORRECT", "WRONG"), help="Use these clips as they are instead of resampling SAMPLE_VIDEOS")
+    parser.add_argument("--images", type=int, default=16, help="Synthetic images for the injury case")
+    parser.add_argument("--image-size", default="1024x768", type=parse_size)
+    parser.add_argument("--scoring", default="cosine", choices=SCORING_METHODS)
+    parser.add_argument("--inference", default="full", choices=tuple(INFERENCE_MODES))
+    parser.add_argument("--profile", default="standard", help="Output encoder profile, see encoding.ENCODER_PROFILES")
+    parser.add_argument("--metrics-only", action="store_true", help="Score without rendering (render=False)")
+    parser.add_argument("--upload-mbps", type=float, help="Simulated upload bandwidth (default: unlimited)")
+    parser.add_argument("--min-detected", type=float, default=0.8,
+                        help="Fail a case when MediaPipe finds a pose in fewer than this share of either video's frames")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--compare", help="Results JSON to compare against")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="netball_benchmark_") as inputs:
+        base_url = serve_directory(inputs)
+        if args.videos:
+            width, height, fps = get_video_properties(args.videos[0])
+            for path, name in zip(args.videos, ("correct.mp4", "wrong.mp4")):
+                shutil.copy(path, os.path.join(inputs, name))
+            inputs_by_case = [({"size": [width, height], "fps": fps, "seconds": None, "videos": args.videos},
+                               (base_url + "correct.mp4", base_url + "wrong.mp4"))]
+        else:
+            inputs_by_case = []
+            for size in args.sizes:
+                for fps in args.fps:
+                    for seconds in args.durations:
+                        name = f"{size[0]}x{size[1]}_{fps}_{seconds:g}"
+                        sample_video(os.path.join(inputs, f"{name}_correct.mp4"), SAMPLE_VIDEOS[0], size, fps, seconds)
+                        sample_video(os.path.join(inputs, f"{name}_wrong.mp4"), SAMPLE_VIDEOS[1], size, fps, seconds * 0.9)
+                        inputs_by_case.append(({"size": list(size), "fps": fps, "seconds": seconds},
+                                               (base_url + f"{name}_correct.mp4", base_url + f"{name}_wrong.mp4")))
+
+        for pipeline in args.pipelines:
+            if pipeline == "injury":
+                image_paths = [os.path.join(inputs, f"image_{index}.jpg") for index in range(args.images)]
+                for index, path in enumerate(image_paths):
+                    synthetic_image(path, args.image_size, seed=index)
+                case = {"pipeline": "injury", "images": args.images, "image_size": list(args.image_size)}
+                results.append(in_fresh_process(run_injury_case, case, image_paths))
+                print(json.dumps(results[-1]))
+                continue
+            for video_case, (correct_url, wrong_url) in inputs_by_case:
+                case = {"pipeline": pipeline, **video_case, "scoring": args.scoring, "inference": args.inference,
+                        "profile": args.profile, "render": not args.metrics_only, "upload_mbps": args.upload_mbps}
+                result = in_fresh_process(run_video_case, case, correct_url, wrong_url)
+                if "error" not in result and min(result["detected"]) < args.min_detected:
+                    result["error"] = (f"MediaPipe found a pose in only {min(result['detected']):.0%} of the frames "
+                                       f"(--min-detected {args.min_detected:.0%}), so the timings don't cover the pose stages")
+                results.append(result)
+                print(json.dumps(results[-1]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_commit(), "created_at": time.time(), "python": platform.python_version(),
+                       "machine": platform.machine(), "cpus": os.cpu_count(), "streaming_upload": storage.STREAMING_UPLOAD,
+                       "cases": results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    failed = [case for case in results if "error" in case]
+    if failed:
+        print(f"{len(failed)} of {len(results)} cases failed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
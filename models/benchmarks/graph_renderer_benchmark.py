@@ -0,0 +1,102 @@
+"""
+Per-frame cost of the animated comparison graph as the clip gets longer.
+
+Run from the models directory:
+    python -m benchmarks.graph_renderer_benchmark
+    python -m benchmarks.graph_renderer_benchmark --lengths 100 400 1600 --legacy
+
+For each clip length the incremental AnimatedGraph is timed over the first
+and the last 10% of frames; a flat ratio means per-frame cost does not grow
+with clip length. --legacy also times the previous approach (a new matplotlib
+figure re-plotting the whole prefix for every frame) for comparison.
+"""
+import argparse
+import json
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+
+from graph_renderer import AnimatedGraph
+
+
+def synthetic_series(length, seed):
+    rng = np.random.default_rng(seed)
+    t = np.arange(length)
+    return 90 + 40 * np.sin(t / 15) + rng.normal(0, 3, length)
+
+
+def build_panels(length):
+    return [
+        {
+            "series": [(synthetic_series(length, 3 * i), 'g-', 'Correct Technique'),
+                       (synthetic_series(length, 3 * i + 1), 'r-', 'Incorrect Technique')],
+            "ylabel": 'Angle (degrees)',
+            "title": f'Panel {i + 1}',
+        }
+        for i in range(3)
+    ]
+
+
+def legacy_frame(panels, frame):
+    """The per-frame figure approach AnimatedGraph replaced"""
+    fig, axes = plt.subplots(3, 1, figsize=(10, 12))
+    for ax, panel in zip(axes, panels):
+        for values, fmt, label in panel["series"]:
+            ax.plot(range(frame + 1), values[:frame + 1], fmt, linewidth=2, label=label)
+        ax.set_title(panel["title"])
+        ax.grid(True)
+        ax.legend()
+    plt.tight_layout()
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+    plt.close(fig)
+    return image
+
+
+def time_frames(render, indices):
+    start = time.perf_counter()
+    for index in indices:
+        render(index)
+    return (time.perf_counter() - start) / len(indices) * 1000
+
+
+def run(lengths, legacy):
+    results = []
+    for length in lengths:
+        panels = build_panels(length)
+        window = max(1, length // 10)
+        head = range(0, window)
+        tail = range(length - window, length)
+
+        start = time.perf_counter()
+        graph = AnimatedGraph(panels, suptitle="Benchmark", figsize=(10, 12))
+        setup_ms = (time.perf_counter() - start) * 1000
+        head_ms = time_frames(graph.frame, head)
+        # Advance to the tail without timing the frames in between
+        graph.frame(tail.start - 1)
+        tail_ms = time_frames(graph.frame, tail)
+
+        result = {
+            "frames": length,
+            "setup_ms": round(setup_ms, 2),
+            "first_frames_ms": round(head_ms, 3),
+            "last_frames_ms": round(tail_ms, 3),
+            "growth": round(tail_ms / head_ms, 2),
+        }
+        if legacy:
+            result["legacy_first_frames_ms"] = round(time_frames(lambda i: legacy_frame(panels, i), head), 3)
+            result["legacy_last_frames_ms"] = round(time_frames(lambda i: legacy_frame(panels, i), tail), 3)
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 400, 1600])
+    parser.add_argument("--legacy", action="store_true", help="also time the per-frame figure approach")
+    args = parser.parse_args()
+    run(args.lengths, args.legacy)
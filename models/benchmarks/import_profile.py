@@ -0,0 +1,62 @@
+"""
+Import-time profile of the service and of each module it loads lazily.
+
+Run from the models directory:
+    python -m benchmarks.import_profile
+    python -m benchmarks.import_profile --modules main injury_detection attack_analysis --top 15
+
+Every module is imported in a fresh interpreter with `python -X importtime`,
+so the numbers are cold-start costs. For each one the report gives the total
+wall time and the slowest top-level packages by total import time, which
+shows what a startup path pulls in (e.g. whether `main` loads TensorFlow).
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+DEFAULT_MODULES = ["main", "injury_detection", "streaming_ingest", "attack_analysis", "defence", "ball_handling"]
+
+
+def profile_import(module):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True)
+    wall = time.perf_counter() - start
+
+    # Lines look like "import time:   self [us] |  cumulative | imported package"
+    packages = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        # Summing each module's own (self) time per top-level package avoids double counting
+        top = name.strip().split(".")[0]
+        packages[top] = packages.get(top, 0) + int(self_us)
+
+    return {
+        "module": module,
+        "ok": proc.returncode == 0,
+        "wall_s": round(wall, 3),
+        "packages": packages,
+        "error": proc.stderr.strip().splitlines()[-1] if proc.returncode != 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        result = profile_import(module)
+        slowest = sorted(result.pop("packages").items(), key=lambda item: item[1], reverse=True)[:args.top]
+        result["slowest_s"] = {name: round(us / 1e6, 3) for name, us in slowest}
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
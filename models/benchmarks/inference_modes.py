@@ -0,0 +1,95 @@
+"""
+Speed and accuracy of the pose inference modes against full inference.
+
+Run from the models directory with real clips (pose needs people in them):
+    python -m benchmarks.inference_modes correct.mp4 wrong.mp4
+    python -m benchmarks.inference_modes correct.mp4 wrong.mp4 --modes fast adaptive --scoring dtw
+    python -m benchmarks.inference_modes correct.mp4 --pose-model lite --modes full fast
+
+Every video goes through each mode, run with the chosen pose model, with the
+landmark cache bypassed. For each mode and video the report gives the
+inference time and speedup over full inference with the full model, how
+often pose detection agrees with it, the mean landmark error (in
+normalized image units) and the mean absolute error of every metric in
+kinematics.METRICS. With two or more videos it also compares the first video
+with each of the others, as the analysis endpoints do, and reports how far
+each metric's similarity moves from the full-inference score.
+"""
+import argparse
+import json
+import time
+import numpy as np
+from inference import INFERENCE_MODES, POSE_MODELS
+from kinematics import METRICS
+from pose_extraction import detect_landmarks, pose_pool, pose_settings
+from scoring import SCORING_METHODS, align, metric_similarity
+from timeseries import MetricSeries
+from video_io import get_video_properties, read_frames
+
+
+def run_mode(video_path, mode, pose_model="full"):
+    start = time.perf_counter()
+    landmarks = detect_landmarks(read_frames(video_path), pose_settings(pose_model), mode)
+    return landmarks, time.perf_counter() - start
+
+
+def landmark_delta(full, fast):
+    """Agreement and error of a mode's landmarks compared with full inference"""
+    full_mask, fast_mask = ~np.isnan(full[:, 0, 0]), ~np.isnan(fast[:, 0, 0])
+    both = full_mask & fast_mask
+    full_metrics = MetricSeries.from_landmarks(full, tuple(METRICS))
+    fast_metrics = MetricSeries.from_landmarks(fast, tuple(METRICS))
+    return {
+        "detection_agreement": float((full_mask == fast_mask).mean()) if len(full) else None,
+        "landmark_error": float(np.abs(full[both, :, :2] - fast[both, :, :2]).mean()) if both.any() else None,
+        "metric_error": {name: float(np.abs(full_metrics[name][both] - fast_metrics[name][both]).mean()) if both.any() else None
+                         for name in METRICS},
+    }
+
+
+def similarities(first, second, scoring):
+    names = tuple(METRICS)
+    first, second, _ = align(MetricSeries.from_landmarks(first, names), MetricSeries.from_landmarks(second, names), names, scoring)
+    return {name: metric_similarity(first[name], second[name], scoring) * 100 for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos", nargs="+")
+    parser.add_argument("--modes", nargs="+", help="Default: every mode other than the reference")
+    parser.add_argument("--scoring", default="cosine", choices=SCORING_METHODS)
+    parser.add_argument("--pose-model", default="full", choices=tuple(POSE_MODELS),
+                        help="Pose model the modes run with; the reference is always full inference with the full model")
+    args = parser.parse_args()
+    if not args.modes:
+        args.modes = [mode for mode in INFERENCE_MODES if mode != "full" or args.pose_model != "full"]
+
+    # Initialize the estimators up front so no mode's timing includes it
+    pose_pool.preload(pose_settings("full"), 1)
+    pose_pool.preload(pose_settings(args.pose_model), 1)
+
+    results = {}
+    for video_path in args.videos:
+        width, height, _ = get_video_properties(video_path)
+        full, full_time = run_mode(video_path, "full")
+        results[video_path] = {"full": full}
+        print(json.dumps({"video": video_path, "mode": "full", "frames": len(full), "size": [width, height],
+                          "seconds": round(full_time, 3), "fps": round(len(full) / full_time, 1) if full_time else None}))
+        for mode in args.modes:
+            landmarks, seconds = run_mode(video_path, mode, args.pose_model)
+            results[video_path][mode] = landmarks
+            print(json.dumps({"video": video_path, "mode": mode, "seconds": round(seconds, 3),
+                              "speedup": round(full_time / seconds, 2) if seconds else None,
+                              **landmark_delta(full, landmarks)}))
+
+    first = args.videos[0]
+    for other in args.videos[1:]:
+        reference = similarities(results[first]["full"], results[other]["full"], args.scoring)
+        for mode in args.modes:
+            scores = similarities(results[first][mode], results[other][mode], args.scoring)
+            print(json.dumps({"pair": [first, other], "mode": mode, "scoring": args.scoring,
+                              "similarity_delta": {name: round(scores[name] - reference[name], 3) for name in scores}}))
+
+
+if __name__ == "__main__":
+    main()
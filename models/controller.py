@@ -1,144 +1,384 @@
-from s3_download import download_s3_file
-from ball_handling import create_combined_visualization
-from defence import analyze_defensive_movement
-from attack_analysis import analyze_movement
-import uuid
+from s3_download import DownloadError, download_s3_file, download_s3_files, redact_url
+import asyncio
+import importlib
 from pydantic import BaseModel
-from fastapi import APIRouter
-import os 
-from pathlib import Path
-import boto3 
-from injury_detection import process_image
-
-
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-AWS_ACCESS_KEY = os.environ.get("AWS_ACCESS_KEY")
-AWS_SECRET_KEY = os.environ.get("AWS_SECRET_KEY")
-
-
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY
-)
-
-
-def predict_ball_handling(correct_video_url , wrong_video_url):
-    correct_video_path = os.path.join(Path(__file__).parent , "input", "ball_handling" , f"{uuid.uuid4()}_correct_video.mp4" )
-    wrong_video_path = os.path.join(Path(__file__).parent , "input", "ball_handling" , f"{uuid.uuid4()}_wrong_video.mp4" )
-    
-    if download_s3_file(url=correct_video_url , output_path=correct_video_path) and download_s3_file(url=wrong_video_url , output_path=wrong_video_path):
-        output_path =os.path.join(Path(__file__).parent , "output", "ball_handling" , f"{uuid.uuid4()}_analysis.mp4")
-        video = create_combined_visualization(correct_video_path=correct_video_path , wrong_video_path=wrong_video_path , output_path=output_path)
-        
-        upload_file_name = f"{os.path.basename(video['output_filepath'])}"
-        s3_client.upload_file(video['output_filepath'], S3_BUCKET_NAME, upload_file_name)
-        file_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{upload_file_name}"
-        
-            
-        return {"file_url":file_url , "similarity":video['similarity_value']}
-
-def predict_attack(correct_video_url , wrong_video_url):
-    correct_video_path = os.path.join(Path(__file__).parent , "input", "attack" , f"{uuid.uuid4()}_correct_video.mp4" )
-    wrong_video_path = os.path.join(Path(__file__).parent , "input", "attack" , f"{uuid.uuid4()}_wrong_video.mp4" )
-    if download_s3_file(url=correct_video_url , output_path=correct_video_path) and download_s3_file(url=wrong_video_url , output_path=wrong_video_path):
-        
-        output_path =os.path.join(Path(__file__).parent , "output", "attack" , f"{uuid.uuid4()}_analysis.mp4")
-        video = analyze_movement(correct_video_path=correct_video_path , incorrect_video_path=wrong_video_path , output_path=output_path)
-        
-        upload_file_name = f"{os.path.basename(video['output_filepath'])}"
-        s3_client.upload_file(video['output_filepath'], S3_BUCKET_NAME, upload_file_name)
-        file_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{upload_file_name}"
-        
-            
-        return {"file_url": file_url, "similarity": video['similarity_metrics']}
-    
-    
-
-def predict_defence(correct_video_url , wrong_video_url):
-    correct_video_path = os.path.join(Path(__file__).parent , "input", "defence" , f"{uuid.uuid4()}_correct_video.mp4" )
-    wrong_video_path = os.path.join(Path(__file__).parent , "input", "defence" , f"{uuid.uuid4()}_wrong_video.mp4" )
-    if download_s3_file(url=correct_video_url , output_path=correct_video_path) and download_s3_file(url=wrong_video_url , output_path=wrong_video_path):
-        
-        output_path =os.path.join(Path(__file__).parent , "output", "defence" , f"{uuid.uuid4()}_analysis.mp4")
-        video = analyze_defensive_movement(correct_video_path=correct_video_path , incorrect_video_path=wrong_video_path , output_path=output_path)
-        
-        upload_file_name = f"{os.path.basename(video['output_filepath'])}"
-        s3_client.upload_file(video['output_filepath'], S3_BUCKET_NAME, upload_file_name)
-        file_url = f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{upload_file_name}"
-        
-            
-        return {"file_url": file_url, "similarity": video['similarity_metrics']}
-    
+from fastapi import APIRouter, HTTPException
+from injury_detection import injury_batcher, preprocess_images
+from artifacts import AnalysisNotFound, cached_render, download_source, load_landmarks, load_record, render_key, save_analysis
+from encoding import encoder_settings
+from errors import TrackNotFound
+from inference import DEFAULT_INFERENCE_MODE, DEFAULT_POSE_MODEL, INFERENCE_MODES, POSE_MODELS, inference_mode
+from jobs import JobQueueFull, get_job, run_job, submit_job, wait_for_job
+from pose_cache import file_hash
+from result_cache import ResultLookup
+from scoring import SCORING_METHODS
+from storage import video_upload
+from timing import count
+from workspace import Workspace
+
+# The analysis pipelines (MediaPipe, matplotlib, moviepy) are imported where
+# they are used: they only ever run inside job worker processes, which preload
+# them at startup (see jobs.JOB_PRELOAD_MODULES). storage imports boto3 lazily.
+
+
+def _analysis_function(kind):
+    analysis = ANALYSES[kind]
+    return getattr(importlib.import_module(analysis["module"]), analysis["function"])
+
+
+def _ingest_videos(downloads, pose_model, inference, multi_person, known_hashes):
+    """
+    Download the (url, path) pairs and return their content hashes, which
+    the rest of the pipeline reuses instead of reading the files again.
+    known_hashes are the hashes the URLs had when last seen (see
+    streaming_ingest.ingest_video). Raises DownloadError when one of them
+    can't be fetched.
+    """
+    from pose_extraction import pose_settings
+    from streaming_ingest import ingest_videos
+    # Pose can't start while downloading in multi-person mode: players are tracked first
+    if multi_person:
+        downloaded = [file_hash(path) if ok else None for (_, path), ok in zip(downloads, download_s3_files(downloads))]
+    else:
+        downloaded = ingest_videos(downloads, pose_settings(pose_model), inference, known_hashes)
+    failed = [redact_url(url) for (url, _), content_hash in zip(downloads, downloaded) if not content_hash]
+    if failed:
+        raise DownloadError(f"Could not download {', '.join(failed)}")
+    return downloaded
+
+
+def _extract_landmarks(paths, hashes, pose_model, inference, tracks):
+    """
+    Both videos' landmarks, hashes being their content hashes. In
+    multi-person mode tracks holds the requested track of each video (None
+    for its main track) and the ids actually used are returned with the
+    landmarks; otherwise tracks is None.
+    """
+    from pose_extraction import extract_landmarks_pair, pose_settings
+    from tracking import resolve_track
+    if tracks is not None:
+        resolved = []
+        for name, path, content_hash, track in zip(("correct", "wrong"), paths, hashes, tracks):
+            try:
+                resolved.append(resolve_track(path, track, content_hash))
+            except TrackNotFound as e:
+                raise TrackNotFound(f"{name} video: {e}")
+        tracks = resolved
+    return extract_landmarks_pair(*paths, pose_settings(pose_model), inference, tracks or (None, None), hashes), tracks
+
+
+def _run_pipeline(kind , correct_video_url , wrong_video_url , scoring="cosine" , inference="full" , pose_model="full" , encoding=None , render=True , include_series=False , tracks=None):
+    """
+    Compare the videos at the two URLs with the analysis of kind (see
+    ANALYSES): download them, extract their landmarks, score and, unless
+    render is False, render and upload the comparison video, then store the
+    analysis and return the response.
+    """
+    analyze = _analysis_function(kind)
+
+    # Resubmissions are answered from the result cache, without downloading when the videos are known
+    lookup = ResultLookup(kind, [correct_video_url, wrong_video_url],
+                          {"scoring": scoring, "inference": inference, "pose_model": pose_model,
+                           "encoding": encoding if render else None, "render": render, "include_series": include_series,
+                           **({"tracks": tracks} if tracks is not None else {})})
+    if lookup.result:
+        return lookup.result
+
+    with Workspace(kind) as workspace:
+        paths = [workspace.path("input", "correct_video.mp4"), workspace.path("input", "wrong_video.mp4")]
+        downloads = list(zip([correct_video_url, wrong_video_url], paths))
+
+        # Each video is hashed once, while it downloads when streaming
+        hashes = _ingest_videos(downloads, pose_model, inference, tracks is not None, lookup.source_hashes)
+        if lookup.check_hashes(hashes):
+            return lookup.result
+        landmarks, tracks = _extract_landmarks(paths, hashes, pose_model, inference, tracks)
+        # The video uploads in parts while it is being encoded
+        with video_upload(workspace, enabled=render) as upload:
+            video = analyze(*paths, upload.output if upload else None, scoring=scoring, encoding=encoding,
+                            render=render, include_series=include_series, landmarks=landmarks)
+        similarity = video[ANALYSES[kind]["scores"]]
+        # Metrics-only requests have no video to upload, and don't wait for the
+        # analysis to be stored either: until its upload finishes, which is
+        # usually well before a client asks, /analyses/{id} answers 404
+        file_url = upload.url if render else None
+        analysis_id = save_analysis(kind, downloads, landmarks, {"scoring": scoring, "inference": inference, "pose_model": pose_model, "tracks": tracks},
+                                    {"similarity": similarity, "alignment": video['alignment']}, workspace, hashes,
+                                    background=not render)
+
+        response = {"file_url": file_url, "similarity": similarity, "alignment": video['alignment'], "inference": inference_mode(inference), "pose_model": pose_model, "encoding": encoding if render else None, "series": video['series'], "tracks": tracks, "analysis_id": analysis_id, "cached": False}
+        lookup.store(response, upload.key if render else None)
+        return response
+
+
+# The job functions, one per analysis (module level so they can be pickled into the workers)
+def predict_ball_handling(correct_video_url , wrong_video_url , **options):
+    return _run_pipeline("ball_handling", correct_video_url, wrong_video_url, **options)
+
+def predict_attack(correct_video_url , wrong_video_url , **options):
+    return _run_pipeline("attack_analysis", correct_video_url, wrong_video_url, **options)
+
+def predict_defence(correct_video_url , wrong_video_url , **options):
+    return _run_pipeline("defence_analysis", correct_video_url, wrong_video_url, **options)
+
+
+# Every analysis by kind: its job function, the module and function that
+# score and render it, and the key of the scores in that function's result
+ANALYSES = {
+    "ball_handling": {"pipeline": predict_ball_handling, "module": "ball_handling", "function": "create_combined_visualization", "scores": "similarity_value"},
+    "attack_analysis": {"pipeline": predict_attack, "module": "attack_analysis", "function": "analyze_movement", "scores": "similarity_metrics"},
+    "defence_analysis": {"pipeline": predict_defence, "module": "defence", "function": "analyze_defensive_movement", "scores": "similarity_metrics"},
+}
+
+
+def render_analysis(analysis_id , encoding):
+    """
+    Render the video of a stored analysis from its landmarks, without running
+    pose inference again. Renders are kept in the bucket next to the analysis,
+    one per encoding, so only the first request for each one does the work.
+    """
+    file_url = cached_render(analysis_id, encoding)
+    if file_url:
+        count("render_cache_hit")
+        return {"file_url": file_url, "cached": True, "encoding": encoding}
+    count("render_cache_miss")
+
+    with Workspace("render") as workspace:
+        record = load_record(analysis_id, workspace)
+        landmarks = load_landmarks(analysis_id, workspace)
+        paths = [workspace.path("input", "correct_video.mp4"), workspace.path("input", "wrong_video.mp4")]
+        if not all([download_source(source, path) for source, path in zip(record["sources"], paths)]):
+            raise DownloadError(f"Could not download the source videos of analysis {analysis_id}")
+        # The landmarks only fit the exact videos they were extracted from
+        for source, path in zip(record["sources"], paths):
+            if file_hash(path) != source["sha256"]:
+                raise ValueError(f"Source video {source['url']} has changed since analysis {analysis_id}")
+
+        analyze = _analysis_function(record["kind"])
+        with video_upload(workspace, render_key(analysis_id, encoding)) as upload:
+            analyze(paths[0], paths[1], upload.output, scoring=record["params"]["scoring"], encoding=encoding, landmarks=landmarks)
+        file_url = upload.url
+        return {"file_url": file_url, "cached": False, "encoding": encoding}
+
+
+class Encoding(BaseModel):
+    # preview (480p, quick to encode and download), standard (720p) or archive
+    # (720p, higher quality), see encoding.py; the other fields override it
+    profile:str = None
+    preset:str = None
+    crf:int = None
+    threads:int = None
+    height:int = None
 
 
 class BallHandling(BaseModel):
     correct_s3_link:str
     wrong_s3_link:str
+    # cosine (default), correlation or dtw, see scoring.py
+    scoring:str = "cosine"
+    # full, fast, fastest or adaptive, see inference.py (POSE_INFERENCE_MODE when not given)
+    inference:str = None
+    # lite, full or heavy MediaPipe Pose model (POSE_MODEL when not given); lite suits quick previews
+    pose_model:str = None
+    encoding:Encoding = None
+    # render=False skips drawing, encoding and the upload and only returns the scores
+    render:bool = True
+    # Add the scored per-frame angle series to the response
+    include_series:bool = False
+    # Add where the time went (queue, download, pose, graph, encode, upload, ...) to the response
+    include_timings:bool = False
+    # Footage with several players: track them and compare the athlete of
+    # correct_track and wrong_track (ids from /tracks; each video's main
+    # track, the player in the most frames, when not given), see tracking.py
+    multi_person:bool = False
+    correct_track:int = None
+    wrong_track:int = None
+
+
+def resolve_encoding(encoding):
+    try:
+        return encoder_settings(**(encoding.model_dump() if encoding else {}))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def analysis_kwargs(ball_handling):
+    if ball_handling.scoring not in SCORING_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown scoring method '{ball_handling.scoring}', expected one of {', '.join(SCORING_METHODS)}")
+    inference = ball_handling.inference or DEFAULT_INFERENCE_MODE
+    if inference not in INFERENCE_MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown inference mode '{inference}', expected one of {', '.join(INFERENCE_MODES)}")
+    pose_model = ball_handling.pose_model or DEFAULT_POSE_MODEL
+    if pose_model not in POSE_MODELS:
+        raise HTTPException(status_code=400, detail=f"Unknown pose model '{pose_model}', expected one of {', '.join(POSE_MODELS)}")
+    encoding = resolve_encoding(ball_handling.encoding)
+    if not ball_handling.multi_person and (ball_handling.correct_track is not None or ball_handling.wrong_track is not None):
+        raise HTTPException(status_code=400, detail="correct_track and wrong_track need multi_person")
+    tracks = [ball_handling.correct_track, ball_handling.wrong_track] if ball_handling.multi_person else None
+    return {"correct_video_url": ball_handling.correct_s3_link, "wrong_video_url": ball_handling.wrong_s3_link,
+            "scoring": ball_handling.scoring, "inference": inference, "pose_model": pose_model, "encoding": encoding,
+            "render": ball_handling.render, "include_series": ball_handling.include_series, "tracks": tracks}
+
+
+async def run_analysis(kind, ball_handling):
+    kwargs = analysis_kwargs(ball_handling)
+    try:
+        job_id = submit_job(kind, ANALYSES[kind]["pipeline"], **kwargs)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        result = await wait_for_job(job_id)
+    except TrackNotFound as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except DownloadError as e:
+        # The videos couldn't be fetched from their links
+        raise HTTPException(status_code=502, detail=str(e))
+    if ball_handling.include_timings:
+        result = {**result, "timings": get_job(job_id)["timings"]}
+    return result
 
 
 router = APIRouter()
 
 @router.post("/ball_handling")
 async def ball_handling_endpoint(ball_handling:BallHandling):
-    predictions = predict_ball_handling(correct_video_url=ball_handling.correct_s3_link , wrong_video_url=ball_handling.wrong_s3_link)
-    folders = ["/app/output/ball_handling" , "/app/output/attack" , "/app/output/defence" , "/app/input/attack" , "/app/input/ball_handling" , "/app/input/defence"]
-        
-    for folder_path in folders:
-        if os.path.exists(folder_path) and os.path.isdir(folder_path):
-            for filename in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        else:
-            print(f"The folder {folder_path} does not exist or is not a directory.") 
+    predictions = await run_analysis("ball_handling", ball_handling)
     return {
         "ball_handling_result":predictions
     }
 
 @router.post("/attack_analysis")
 async def attack_analysis_endpoint(ball_handling:BallHandling):
-    predictions = predict_attack(correct_video_url=ball_handling.correct_s3_link , wrong_video_url=ball_handling.wrong_s3_link)
-    folders = ["/app/output/ball_handling" , "/app/output/attack" , "/app/output/defence" , "/app/input/attack" , "/app/input/ball_handling" , "/app/input/defence"]
-        
-    for folder_path in folders:
-        if os.path.exists(folder_path) and os.path.isdir(folder_path):
-            for filename in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        else:
-            print(f"The folder {folder_path} does not exist or is not a directory.") 
+    predictions = await run_analysis("attack_analysis", ball_handling)
     return {
         "attack_analysis_result":predictions
     }
 
 @router.post("/defence_analysis")
 async def defence_analysis_endpoint(ball_handling:BallHandling):
-    predictions = predict_defence(correct_video_url=ball_handling.correct_s3_link , wrong_video_url=ball_handling.wrong_s3_link)
-    folders = ["/app/output/ball_handling" , "/app/output/attack" , "/app/output/defence" , "/app/input/attack" , "/app/input/ball_handling" , "/app/input/defence"]
-        
-    for folder_path in folders:
-        if os.path.exists(folder_path) and os.path.isdir(folder_path):
-            for filename in os.listdir(folder_path):
-                file_path = os.path.join(folder_path, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-        else:
-            print(f"The folder {folder_path} does not exist or is not a directory.") 
-        
+    predictions = await run_analysis("defence_analysis", ball_handling)
     return {
         "defence_analysis_result":predictions
     }
 
 
+def list_tracks(video_url):
+    """The players tracked in a video, to choose correct_track or wrong_track from"""
+    from tracking import main_track, person_tracks, track_summary
+    with Workspace("tracks") as workspace:
+        video_path = workspace.path("input", "video.mp4")
+        if not download_s3_file(video_url, video_path):
+            raise DownloadError(f"Could not download {video_url}")
+        tracks = person_tracks(video_path)
+        return {"frames": len(tracks), "main_track": main_track(tracks), "tracks": track_summary(tracks)}
+
+
+class TrackRequest(BaseModel):
+    s3_link:str
+
+@router.post("/tracks")
+async def tracks_endpoint(track_request:TrackRequest):
+    # Tracks are cached by content, so analysing one of them afterwards doesn't detect people again
+    try:
+        return await run_job("tracks", list_tracks, track_request.s3_link)
+    except DownloadError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+class RenderRequest(BaseModel):
+    encoding:Encoding = None
+
+@router.get("/analyses/{analysis_id}")
+async def get_analysis(analysis_id:str):
+    with Workspace("analysis") as workspace:
+        try:
+            return await asyncio.to_thread(load_record, analysis_id, workspace)
+        except AnalysisNotFound:
+            raise HTTPException(status_code=404, detail="Analysis not found")
+
+@router.post("/analyses/{analysis_id}/render")
+async def render_analysis_endpoint(analysis_id:str , render_request:RenderRequest = None):
+    # Renders the video of a stored analysis (e.g. one run with render=False) the first time it's requested
+    encoding = resolve_encoding(render_request.encoding if render_request else None)
+    try:
+        return await run_job("render", render_analysis, analysis_id, encoding)
+    except AnalysisNotFound:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    except DownloadError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@router.post("/jobs/{kind}")
+async def submit_analysis_job(kind:str , ball_handling:BallHandling):
+    if kind not in ANALYSES:
+        raise HTTPException(status_code=404, detail=f"Unknown analysis '{kind}'")
+    try:
+        job_id = submit_job(kind, ANALYSES[kind]["pipeline"], **analysis_kwargs(ball_handling))
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return get_job(job_id)
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id:str):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
 class InjuryImage(BaseModel):
     s3_link:str 
 
+class InjuryImages(BaseModel):
+    s3_links:list[str]
+
+# Unfinished injury predictions by image URL: (task, index of the image in the task's result)
+_injury_inflight = {}
+
+
+async def _predict_injuries(links):
+    with Workspace("injury") as workspace:
+        image_paths = [workspace.path(f"injury_{i}.png") for i in range(len(links))]
+        downloaded = await asyncio.to_thread(download_s3_files, list(zip(links, image_paths)))
+        decoded = iter(await asyncio.to_thread(preprocess_images, [path for path, ok in zip(image_paths, downloaded) if ok]))
+        # Images that failed to download or can't be decoded get null
+        image_arrays = [next(decoded) if ok else None for ok in downloaded]
+        predictions = iter(await injury_batcher.submit_many([array for array in image_arrays if array is not None]))
+        return [next(predictions) if array is not None else None for array in image_arrays]
+
+
+async def predict_injuries(links):
+    """
+    Injury predictions for the images at links. An image whose prediction is
+    already under way for another request (or appears twice) is downloaded
+    and predicted once, and every request gets that result. The work runs in
+    its own task, so a request that goes away doesn't cancel it for the others.
+    """
+    new = [link for link in dict.fromkeys(links) if link not in _injury_inflight]
+    if len(new) < len(links):
+        count("injury_coalesced", len(links) - len(new))
+    if new:
+        task = asyncio.create_task(_predict_injuries(new))
+        for index, link in enumerate(new):
+            _injury_inflight[link] = (task, index)
+        task.add_done_callback(lambda _: [_injury_inflight.pop(link) for link in new])
+    # Taken before awaiting anything, as finished tasks leave _injury_inflight
+    pending = [_injury_inflight[link] for link in links]
+    return [(await asyncio.shield(task))[index] for task, index in pending]
+
+
 @router.post("/injury-detection")
 async def injury_detection(image_path:InjuryImage):
-    image = os.path.join(Path(__file__).parent , "input", "injury" , f"{uuid.uuid4()}_injury.png" )
-    if download_s3_file(url=image_path.s3_link , output_path=image):
-        injury_result = process_image(image_path=image)
-        os.remove(image)
-        return injury_result
\ No newline at end of file
+    # Concurrent requests are coalesced into a single forward pass
+    injury_result, = await predict_injuries([image_path.s3_link])
+    return injury_result
+
+@router.post("/injury-detection/batch")
+async def injury_detection_batch(images:InjuryImages):
+    return {
+        "injury_results":await predict_injuries(images.s3_links)
+    }
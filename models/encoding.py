@@ -0,0 +1,52 @@
+import os
+
+
+# Named output video profiles. size is the output canvas (width, height), preset
+# and crf go to libx264: faster presets encode quicker for a larger file at the
+# same quality, and a higher crf gives a smaller file of lower quality.
+ENCODER_PROFILES = {
+    "preview": {"size": (854, 480), "preset": "veryfast", "crf": 30},
+    "standard": {"size": (1280, 720), "preset": "medium", "crf": 23},
+    "archive": {"size": (1280, 720), "preset": "slow", "crf": 18},
+}
+X264_PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+
+DEFAULT_ENCODER_PROFILE = os.environ.get("ENCODER_PROFILE", "standard")
+# 0 lets x264 use every available core
+ENCODER_THREADS = int(os.environ.get("ENCODER_THREADS", 0))
+
+
+def _even(value):
+    # yuv420p needs even dimensions
+    return max(2, int(round(value / 2)) * 2)
+
+
+def encoder_settings(profile=None, preset=None, crf=None, threads=None, height=None):
+    """
+    Settings of a named profile with any per-request overrides applied.
+    height scales the canvas, keeping the profile's aspect ratio.
+    Raises ValueError for an unknown profile or an out-of-range override.
+    """
+    profile = profile or DEFAULT_ENCODER_PROFILE
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown output profile '{profile}', expected one of {', '.join(ENCODER_PROFILES)}")
+    settings = {"profile": profile, **ENCODER_PROFILES[profile], "threads": ENCODER_THREADS}
+
+    if preset is not None:
+        if preset not in X264_PRESETS:
+            raise ValueError(f"Unknown preset '{preset}', expected one of {', '.join(X264_PRESETS)}")
+        settings["preset"] = preset
+    if crf is not None:
+        if not 0 <= crf <= 51:
+            raise ValueError("crf must be between 0 and 51")
+        settings["crf"] = crf
+    if threads is not None:
+        if threads < 0:
+            raise ValueError("threads must be 0 (all cores) or more")
+        settings["threads"] = threads
+    if height is not None:
+        if not 144 <= height <= 2160:
+            raise ValueError("height must be between 144 and 2160")
+        width, profile_height = settings["size"]
+        settings["size"] = (_even(height * width / profile_height), _even(height))
+    return settings
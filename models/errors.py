@@ -0,0 +1,7 @@
+# Exceptions raised by jobs that the API maps to HTTP errors. They are kept
+# apart from the modules that raise them, so the API process can catch them
+# without importing OpenCV or MediaPipe (see controller.py).
+
+
+class TrackNotFound(Exception):
+    """Raised when a video has no track with the requested id (or no tracks at all)"""
@@ -0,0 +1,91 @@
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from timing import stage
+
+
+class AnimatedGraph:
+    """
+    Incrementally rendered line graph animation.
+
+    The figure, axes, titles, grid and legends are drawn once. Every following
+    frame only draws the newest segment of each line on top of the previous
+    frame (the lines only ever grow), so rendering a frame costs the same at the
+    end of a long clip as at the start.
+
+    panels is a list of dicts, one subplot each, with keys:
+        series: list of (values, fmt, label) tuples, e.g. (angles, 'g-', 'Correct Technique')
+        title, xlabel, ylabel: optional axis text
+        xlim, ylim: optional fixed limits (computed from the full data otherwise)
+    """
+
+    def __init__(self, panels, suptitle=None, figsize=(10, 12), dpi=100):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.frame_count = max((len(values) for panel in panels for values, _, _ in panel["series"]), default=0)
+
+        axes = self.figure.subplots(len(panels), 1, squeeze=False)[:, 0]
+        self.lines = []
+        self.legends = []
+        for ax, panel in zip(axes, panels):
+            for values, fmt, label in panel["series"]:
+                line, = ax.plot([], [], fmt, linewidth=2, label=label, animated=True)
+                self.lines.append((ax, line, np.asarray(values, dtype=float)))
+
+            ax.set_xlim(*panel.get("xlim", (0, max(self.frame_count - 1, 1))))
+            ax.set_ylim(*panel.get("ylim", self._data_limits(panel["series"])))
+            ax.set_title(panel.get("title", ""))
+            ax.set_xlabel(panel.get("xlabel", ""))
+            ax.set_ylabel(panel.get("ylabel", ""))
+            ax.grid(True)
+            # Opaque legend at a fixed spot so it can be redrawn over new segments
+            legend = ax.legend(loc="upper right", framealpha=1.0)
+            legend.set_animated(True)
+            self.legends.append((ax, legend))
+
+        if suptitle:
+            self.figure.suptitle(suptitle, fontsize=16)
+        self.figure.tight_layout()
+        if suptitle:
+            self.figure.subplots_adjust(top=0.9)  # Make room for the suptitle
+
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.next_index = 0
+
+    @staticmethod
+    def _data_limits(series):
+        values = [v for v, _, _ in series if len(v)]
+        if not values:
+            return (0, 1)
+        low = min(float(np.min(v)) for v in values)
+        high = max(float(np.max(v)) for v in values)
+        margin = (high - low) * 0.05 or 1
+        return (low - margin, high + margin)
+
+    def _reset(self):
+        self.canvas.restore_region(self.background)
+        self.next_index = 0
+
+    def _draw_segment(self, index):
+        for ax, line, values in self.lines:
+            if 0 < index < len(values):
+                line.set_data([index - 1, index], values[index - 1:index + 1])
+                ax.draw_artist(line)
+        for ax, legend in self.legends:
+            ax.draw_artist(legend)
+
+    def frame(self, index):
+        """Return frame `index` as an RGB array. Sequential access is the fast path."""
+        with stage("graph"):
+            if index < self.next_index - 1:
+                self._reset()
+            while self.next_index <= index:
+                self._draw_segment(self.next_index)
+                self.next_index += 1
+            return np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy()
+
+    def frames(self):
+        """Yield every frame of the animation in order"""
+        for index in range(self.frame_count):
+            yield self.frame(index)
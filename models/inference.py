@@ -0,0 +1,30 @@
+import os
+
+
+# Pose inference trade-offs, selectable per request.
+#   stride:   run pose on every Nth frame and interpolate the landmarks in between
+#   max_side: downscale frames so their longer side is at most this many pixels
+#             before inference (landmarks are normalized, so they are unaffected)
+#   adaptive: also run pose before the stride is up when the picture has changed
+#             by more than MOTION_THRESHOLD since the last inferred frame
+INFERENCE_MODES = {
+    "full": {"stride": 1, "max_side": None, "adaptive": False},
+    "fast": {"stride": 2, "max_side": 640, "adaptive": False},
+    "fastest": {"stride": 4, "max_side": 480, "adaptive": False},
+    "adaptive": {"stride": 4, "max_side": 640, "adaptive": True},
+}
+
+# MediaPipe Pose model_complexity of each pose model
+POSE_MODELS = {"lite": 0, "full": 1, "heavy": 2}
+
+DEFAULT_INFERENCE_MODE = os.environ.get("POSE_INFERENCE_MODE", "full")
+DEFAULT_POSE_MODEL = os.environ.get("POSE_MODEL", "full")
+# Mean absolute difference (0-255) between 64x64 grayscale thumbnails
+MOTION_THRESHOLD = float(os.environ.get("POSE_MOTION_THRESHOLD", 6.0))
+
+
+def inference_mode(name):
+    """The parameters of a named inference mode, as reported back in responses"""
+    if name not in INFERENCE_MODES:
+        raise ValueError(f"Unknown inference mode '{name}', expected one of {tuple(INFERENCE_MODES)}")
+    return {"mode": name, **INFERENCE_MODES[name]}
@@ -1,39 +1,108 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from PIL import Image
 import numpy as np
-from tensorflow import keras
-import tensorflow as tf
-
-# Print versions
-print(f"TensorFlow version: {tf.__version__}")
-print(f"Keras version: {tf.keras.__version__}")
-
-# Load model
-try:
-    model = keras.models.load_model("netball_injury_model.keras")
-    print("Model loaded successfully!")
-    print(f"Model input shape: {model.input_shape}")
-    print(f"Model output shape: {model.output_shape}")
-except Exception as e:
-    print(f"Detailed error: {e}")
-    print(f"Error type: {type(e)}")
-    import traceback
-    traceback.print_exc()
+from batching import MicroBatcher
+from timing import stage
+
+INJURY_MODEL_PATH = os.environ.get("INJURY_MODEL_PATH", os.path.join(Path(__file__).parent, "netball_injury_model.keras"))
+# Concurrent requests arriving within this window share one forward pass
+INJURY_BATCH_WINDOW_MS = float(os.environ.get("INJURY_BATCH_WINDOW_MS", 10))
+INJURY_MAX_BATCH = int(os.environ.get("INJURY_MAX_BATCH", 32))
+INJURY_DECODE_WORKERS = int(os.environ.get("INJURY_DECODE_WORKERS", 4))
+
+IMG_HEIGHT, IMG_WIDTH = 224, 224
+CLASS_NAMES = ['abrasions', 'mild_bruises', 'severe_bruise']
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def load_model():
+    """
+    Load the Keras model on first use.
+    TensorFlow is only imported here, so the service starts without it and
+    endpoints that never classify images never pay for it.
+    """
+    global _model
+    with _model_lock:
+        if _model is not None:
+            return _model
+
+        from tensorflow import keras
+        import tensorflow as tf
+
+        # Print versions
+        print(f"TensorFlow version: {tf.__version__}")
+        print(f"Keras version: {tf.keras.__version__}")
+
+        try:
+            model = keras.models.load_model(INJURY_MODEL_PATH)
+            print("Model loaded successfully!")
+            print(f"Model input shape: {model.input_shape}")
+            print(f"Model output shape: {model.output_shape}")
+            # Warm up so the first request doesn't pay for building the predict function
+            model.predict_on_batch(np.zeros((1, IMG_HEIGHT, IMG_WIDTH, 3), dtype="float32"))
+        except Exception as e:
+            print(f"Detailed error: {e}")
+            print(f"Error type: {type(e)}")
+            raise
+
+        _model = model
+        return _model
+
+
+def preprocess_image(image_path):
+    """Load an image as a normalized (224, 224, 3) float array"""
+    with stage("decode"):
+        image = Image.open(image_path).convert("RGB")  # ensure 3 channels
+        image_resized = image.resize((IMG_WIDTH, IMG_HEIGHT))
+        return np.array(image_resized).astype("float32") / 255.0  # normalize
+
+
+def _try_preprocess_image(image_path):
+    try:
+        return preprocess_image(image_path)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Could not decode {os.path.basename(image_path)}: {e}")
+        return None
+
+
+def preprocess_images(image_paths):
+    """
+    Decode and resize several images in parallel (PIL releases the GIL while doing so).
+    An image that can't be decoded (not an image, truncated) gives None instead of failing the others.
+    """
+    with ThreadPoolExecutor(max_workers=INJURY_DECODE_WORKERS) as executor:
+        return list(executor.map(_try_preprocess_image, image_paths))
+
+
+def predict_images(image_arrays):
+    """Classify preprocessed images in a single forward pass per INJURY_MAX_BATCH images"""
+    model = load_model()
+    results = []
+    for start in range(0, len(image_arrays), INJURY_MAX_BATCH):
+        image_batch = np.stack(image_arrays[start:start + INJURY_MAX_BATCH])
+        # predict_on_batch skips the dataset and callback setup predict() does on every call
+        with stage("inference"):
+            preds = np.asarray(model.predict_on_batch(image_batch))
+        for pred in preds:
+            results.append({"class": CLASS_NAMES[int(np.argmax(pred))], "probability": float(round(np.max(pred), 6))})
+    return results
 
 
 def process_image(image_path):
     """Process an image and return predicted class with probability."""
-    img_height, img_width = 224, 224
-    class_names = ['abrasions', 'mild_bruises', 'severe_bruise']
+    return predict_images([preprocess_image(image_path)])[0]
+
 
-    # Load and preprocess image
-    image = Image.open(image_path).convert("RGB")  # ensure 3 channels
-    image_resized = image.resize((img_width, img_height))
-    image_array = np.array(image_resized).astype("float32") / 255.0  # normalize
-    image_batch = np.expand_dims(image_array, axis=0)  # shape (1,224,224,3)
+def process_images(image_paths):
+    """Process several images and return a prediction for each (None for images that can't be decoded)"""
+    image_arrays = preprocess_images(image_paths)
+    predictions = iter(predict_images([array for array in image_arrays if array is not None]))
+    return [next(predictions) if array is not None else None for array in image_arrays]
 
-    # Predict
-    pred = model.predict(image_batch)
-    output_class = class_names[np.argmax(pred)]
-    probability = float(round(np.max(pred[0]), 6))
 
-    return {"class": output_class, "probability": probability}
+injury_batcher = MicroBatcher(predict_images, max_batch=INJURY_MAX_BATCH, window=INJURY_BATCH_WINDOW_MS / 1000)
@@ -0,0 +1,259 @@
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from timing import breakdown, count, record_stages
+
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", os.cpu_count() or 1))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", 32))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 3600))
+# Modules every worker imports as it starts, so the first job doesn't pay for
+# them. A module that defines warm_up() has it called as well (pose_extraction
+# fills its pose pool that way).
+JOB_PRELOAD_MODULES = [name for name in os.environ.get("JOB_PRELOAD_MODULES", "attack_analysis,defence,ball_handling,streaming_ingest,pose_extraction").split(",") if name]
+# Submitting a job identical to one still queued or running attaches to that
+# job instead of starting another (see submit_job)
+JOB_COALESCE = os.environ.get("JOB_COALESCE", "1") == "1"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised when the number of pending jobs reaches JOB_QUEUE_LIMIT"""
+
+
+_lock = threading.Lock()
+_jobs = {}
+# Job id of every unfinished job by its _job_key()
+_inflight = {}
+_executor = None
+_manager = None
+_progress = None
+
+# Set inside a worker process while it is running a job
+_worker_job = None
+
+
+def _init_worker(modules):
+    for name in modules:
+        try:
+            module = importlib.import_module(name)
+            if hasattr(module, "warm_up"):
+                module.warm_up()
+        except Exception as e:
+            print(f"Worker could not preload {name}: {e}")
+
+
+def _get_executor():
+    """Create the worker pool on first use so importing this module stays cheap"""
+    global _executor, _manager, _progress
+    with _lock:
+        if _executor is None:
+            # Spawn instead of fork: the parent runs uvicorn threads and may have
+            # TensorFlow loaded, neither of which survives a fork safely
+            context = multiprocessing.get_context("spawn")
+            _manager = context.Manager()
+            _progress = _manager.dict()
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=context,
+                                            initializer=_init_worker, initargs=(JOB_PRELOAD_MODULES,))
+    return _executor
+
+
+def prestart_workers():
+    """Start the worker processes now rather than on the first jobs, and wait until they are up"""
+    executor = _get_executor()
+    # Each submit spawns another worker while none is idle
+    futures = [executor.submit(os.getpid) for _ in range(JOB_WORKERS)]
+    return sorted({future.result() for future in futures})
+
+
+def _run_job(job_id, progress, fn, args, kwargs):
+    """Entry point executed in the worker process"""
+    global _worker_job
+    _worker_job = (job_id, progress)
+    progress[job_id] = {"status": RUNNING, "started_at": time.time()}
+    # The stage timings go back with the job's final progress state
+    with record_stages() as timings:
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            report_progress(timings=timings.summary())
+            _worker_job = None
+
+
+def report_progress(**info):
+    """Merge progress information into the running job's status (no-op outside a job)"""
+    if _worker_job is None:
+        return
+    job_id, progress = _worker_job
+    state = dict(progress.get(job_id, {}))
+    state.update(info)
+    progress[job_id] = state
+
+
+def _on_done(job_id, future):
+    state = _progress.pop(job_id, {}) if _progress is not None else {}
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        if _inflight.get(job["key"]) == job_id:
+            del _inflight[job["key"]]
+        job["started_at"] = state.get("started_at")
+        job["finished_at"] = time.time()
+        if future.cancelled():
+            # Cancelled before it started (pool shutdown); it must still stop counting as pending
+            job["status"] = FAILED
+            job["error"] = "Cancelled"
+            print(f"Job {job_id} ({job['kind']}) was cancelled")
+        elif future.exception() is None:
+            job["status"] = DONE
+            job["result"] = future.result()
+        else:
+            error = future.exception()
+            job["status"] = FAILED
+            job["error"] = f"{type(error).__name__}: {error}"
+            print(f"Job {job_id} ({job['kind']}) failed")
+            traceback.print_exception(type(error), error, error.__traceback__)
+
+        # Where the job's time went: waiting for a worker, then in each stage
+        started_at = job["started_at"]
+        queued = started_at - job["created_at"] if started_at else None
+        ran = job["finished_at"] - started_at if started_at else None
+        if state.get("timings"):
+            job["timings"] = {"queue_seconds": queued, "run_seconds": ran, **breakdown(state["timings"])}
+        metrics.observe_job(job["kind"], job["status"], queued, ran, state.get("timings"))
+
+
+def _evict_expired():
+    now = time.time()
+    for job_id in list(_jobs):
+        finished_at = _jobs[job_id]["finished_at"]
+        if finished_at is not None and now - finished_at > JOB_RESULT_TTL:
+            del _jobs[job_id]
+
+
+def _pending_count():
+    return sum(1 for job in _jobs.values() if job["finished_at"] is None)
+
+
+def job_counts():
+    """{(kind, queued or running): count} of the unfinished jobs"""
+    with _lock:
+        pending = [(job_id, job["kind"]) for job_id, job in _jobs.items() if job["finished_at"] is None]
+    counts = {}
+    for job_id, kind in pending:
+        state = _progress.get(job_id, {}) if _progress is not None else {}
+        key = (kind, state.get("status", QUEUED))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+metrics.gauge("netball_jobs", "Unfinished jobs: queue depth and jobs in flight", ("kind", "state"), job_counts)
+metrics.gauge("netball_job_workers", "Size of the job worker pool", (), lambda: {(): JOB_WORKERS})
+
+
+def _job_key(kind, fn, args, kwargs):
+    try:
+        return json.dumps([kind, fn.__module__, fn.__qualname__, args, kwargs], sort_keys=True)
+    except TypeError:
+        # Arguments that aren't JSON-serializable are never coalesced
+        return None
+
+
+def submit_job(kind, fn, *args, **kwargs):
+    """
+    Queue fn(*args, **kwargs) on the worker pool and return the job id immediately.
+    fn must be a module level function so it can be pickled into the worker.
+    While a job with the same kind, function and arguments is queued or
+    running, its id is returned instead and every caller gets its result.
+    """
+    executor = _get_executor()
+    job_id = str(uuid.uuid4())
+    key = _job_key(kind, fn, args, kwargs) if JOB_COALESCE else None
+
+    with _lock:
+        _evict_expired()
+        if key is not None and key in _inflight:
+            job = _jobs[_inflight[key]]
+            job["requests"] += 1
+            count("job_coalesced")
+            return job["job_id"]
+        if _pending_count() >= JOB_QUEUE_LIMIT:
+            raise JobQueueFull(f"{JOB_QUEUE_LIMIT} jobs are already pending")
+
+        future = executor.submit(_run_job, job_id, _progress, fn, args, kwargs)
+        _jobs[job_id] = {
+            "job_id": job_id,
+            "kind": kind,
+            "status": QUEUED,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+            "timings": None,
+            # Number of submissions this job is answering
+            "requests": 1,
+            "key": key,
+            "future": future,
+        }
+        if key is not None:
+            _inflight[key] = job_id
+
+    future.add_done_callback(lambda f: _on_done(job_id, f))
+    return job_id
+
+
+def get_job(job_id):
+    """Return a JSON-serializable snapshot of a job, or None if it is unknown or expired"""
+    with _lock:
+        _evict_expired()
+        job = _jobs.get(job_id)
+        if job is None:
+            return None
+        view = {key: value for key, value in job.items() if key not in ("future", "key")}
+
+    if view["status"] == QUEUED and _progress is not None:
+        # The raw timings a finishing job reports are summarized by _on_done
+        view.update({key: value for key, value in _progress.get(job_id, {}).items() if key != "timings"})
+    return view
+
+
+async def wait_for_job(job_id):
+    """
+    Await a job's result without blocking the event loop. A waiter that is
+    cancelled (e.g. its client went away) leaves the job running for the
+    other requests it answers.
+    """
+    with _lock:
+        future = _jobs[job_id]["future"]
+    return await asyncio.shield(asyncio.wrap_future(future))
+
+
+async def run_job(kind, fn, *args, **kwargs):
+    """Submit a job and wait for its result"""
+    job_id = submit_job(kind, fn, *args, **kwargs)
+    return await wait_for_job(job_id)
+
+
+def shutdown():
+    """Stop the worker pool, letting running jobs finish"""
+    global _executor, _manager, _progress
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _manager.shutdown()
+        _executor = None
+        _manager = None
+        _progress = None
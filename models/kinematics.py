@@ -0,0 +1,95 @@
+import numpy as np
+
+
+# MediaPipe Pose landmark indices (mp.solutions.pose.PoseLandmark), duplicated
+# here so computing metrics doesn't require importing MediaPipe
+LEFT_SHOULDER = 11
+RIGHT_SHOULDER = 12
+LEFT_ELBOW = 13
+RIGHT_ELBOW = 14
+LEFT_WRIST = 15
+RIGHT_WRIST = 16
+LEFT_HIP = 23
+RIGHT_HIP = 24
+LEFT_KNEE = 25
+RIGHT_KNEE = 26
+LEFT_ANKLE = 27
+RIGHT_ANKLE = 28
+
+
+def joint_angle(a, b, c):
+    """Angle at b in degrees (0-180) between b->a and b->c, for (..., 2) arrays of points"""
+    radians = np.arctan2(c[..., 1] - b[..., 1], c[..., 0] - b[..., 0]) - np.arctan2(a[..., 1] - b[..., 1], a[..., 0] - b[..., 0])
+    angle = np.abs(radians * 180.0 / np.pi)
+    return np.where(angle > 180.0, 360 - angle, angle)
+
+
+def distance(a, b):
+    """Euclidean distance between (..., 2) arrays of points"""
+    return np.hypot(a[..., 0] - b[..., 0], a[..., 1] - b[..., 1])
+
+
+def midpoint(a, b):
+    return (a + b) / 2
+
+
+def point(landmarks, index):
+    """x, y of one landmark in every frame, shape (frames, 2)"""
+    return landmarks[:, index, :2]
+
+
+def shoulder_alignment(landmarks):
+    """Angle of the shoulder line relative to horizontal"""
+    left_shoulder = point(landmarks, LEFT_SHOULDER)
+    right_shoulder = point(landmarks, RIGHT_SHOULDER)
+    horizontal_point = np.stack([left_shoulder[:, 0], right_shoulder[:, 1]], axis=-1)
+    return joint_angle(horizontal_point, right_shoulder, left_shoulder)
+
+
+def hip_stance(landmarks):
+    left_hip = point(landmarks, LEFT_HIP)
+    right_hip = point(landmarks, RIGHT_HIP)
+    return joint_angle(left_hip, midpoint(left_hip, right_hip), right_hip)
+
+
+def stance_width(landmarks):
+    """Average hip to knee distance of both legs"""
+    left = distance(point(landmarks, LEFT_HIP), point(landmarks, LEFT_KNEE))
+    right = distance(point(landmarks, RIGHT_HIP), point(landmarks, RIGHT_KNEE))
+    return (left + right) / 2
+
+
+def _joint(a, b, c):
+    return lambda landmarks: joint_angle(point(landmarks, a), point(landmarks, b), point(landmarks, c))
+
+
+# Every metric maps a (frames, 33, >=2) landmark array to one value per frame.
+# Adding a metric is one entry here.
+METRICS = {
+    "shoulder_alignment": shoulder_alignment,
+    "left_elbow": _joint(LEFT_SHOULDER, LEFT_ELBOW, LEFT_WRIST),
+    "right_elbow": _joint(RIGHT_SHOULDER, RIGHT_ELBOW, RIGHT_WRIST),
+    "left_knee": _joint(LEFT_HIP, LEFT_KNEE, LEFT_ANKLE),
+    "right_knee": _joint(RIGHT_HIP, RIGHT_KNEE, RIGHT_ANKLE),
+    "hip_stance": hip_stance,
+    "stance_width": stance_width,
+}
+
+
+def pose_mask(landmarks):
+    """True for the frames where a pose was detected"""
+    return ~np.isnan(np.asarray(landmarks)[:, 0, 0])
+
+
+def compute_metrics(landmarks, names=tuple(METRICS)):
+    """
+    Compute metrics for a whole clip at once.
+    landmarks is a (frames, 33, 3 or 4) array (only x and y are used). Returns a
+    structured array with one float field per metric name and one row per
+    frame; rows of frames without a pose are NaN.
+    """
+    landmarks = np.asarray(landmarks, dtype=float)
+    metrics = np.empty(len(landmarks), dtype=[(name, float) for name in names])
+    for name in names:
+        metrics[name] = METRICS[name](landmarks)
+    return metrics
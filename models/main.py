@@ -1,7 +1,13 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from controller import router as netball_models
+import metrics
+from injury_detection import load_model as load_injury_model
+from jobs import prestart_workers, shutdown as shutdown_jobs
+from startup import WARMUP_ON_STARTUP, readiness, start_warmup
 import os 
+import time
 
 app = FastAPI()
 app.add_middleware(
@@ -15,4 +21,46 @@ app.add_middleware(
       
             
 
-app.include_router(netball_models , prefix="/netball-project")
\ No newline at end of file
+app.include_router(netball_models , prefix="/netball-project")
+
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template so ids in paths don't create a series each
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.http_requests.inc(request.method, path, status)
+        metrics.http_duration.observe(time.perf_counter() - start, request.method, path)
+
+
+def warm_up():
+    if WARMUP_ON_STARTUP:
+        start_warmup({
+            "injury_model": load_injury_model,
+            "analysis_workers": prestart_workers,
+        })
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ready")
+async def ready():
+    state = readiness()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
+
+
+app.add_event_handler("startup", warm_up)
+app.add_event_handler("shutdown", shutdown_jobs)
\ No newline at end of file
@@ -0,0 +1,135 @@
+import threading
+from timing import BUCKETS, Timings, process_timings
+
+
+# Metrics of the API process in the Prometheus text format, served on /metrics.
+# Analyses run in the job worker processes: each job's stage timings come back
+# with its result (see jobs.py) and are added to the totals here, together
+# with what the API process times itself (downloads and injury inference).
+
+
+class Counter:
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def lines(self):
+        with self.lock:
+            values = dict(self.values)
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    """Durations in seconds over timing.BUCKETS, kept as a Timings keyed by label values"""
+
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.timings = Timings()
+
+    def observe(self, seconds, *labels):
+        self.timings.add(labels, seconds)
+
+    def lines(self):
+        stages = self.timings.summary()["stages"]
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, entry in sorted(stages.items()):
+            yield from _histogram_lines(self.name, self.labelnames, labels, entry)
+
+
+class Gauge:
+    """Value read when scraped: fn() returns {label values: value}"""
+
+    def __init__(self, name, help, labelnames, fn):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.fn = fn
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in sorted(self.fn().items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def _histogram_lines(name, labelnames, labels, entry):
+    cumulative = 0
+    for bound, count in zip((*BUCKETS, "+Inf"), entry["buckets"]):
+        cumulative += count
+        yield f"{name}_bucket{_labels((*labelnames, 'le'), (*labels, bound))} {cumulative}"
+    yield f"{name}_sum{_labels(labelnames, labels)} {entry['seconds']}"
+    yield f"{name}_count{_labels(labelnames, labels)} {entry['calls']}"
+
+
+http_requests = Counter("netball_http_requests_total", "HTTP requests by route and status code", ("method", "route", "status"))
+http_duration = Histogram("netball_http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+jobs_finished = Counter("netball_jobs_total", "Finished jobs by kind and outcome", ("kind", "status"))
+job_queue_time = Histogram("netball_job_queue_seconds", "Time jobs waited for a worker", ("kind",))
+job_run_time = Histogram("netball_job_duration_seconds", "Time jobs ran on a worker", ("kind",))
+job_stage_time = Histogram("netball_job_stage_seconds", "Time each job spent in each stage", ("kind", "stage"))
+gauges = []
+
+# Stage calls (a frame's pose inference, an encoder write, a batch's model
+# inference, an upload part) of finished jobs, added to process_timings
+_worker_timings = Timings()
+
+
+def gauge(name, help, labelnames, fn):
+    gauges.append(Gauge(name, help, labelnames, fn))
+
+
+def observe_job(kind, status, queued, ran, timings):
+    """Record a finished job: its outcome, queue and run times and its Timings summary"""
+    jobs_finished.inc(kind, status)
+    if queued is not None:
+        job_queue_time.observe(queued, kind)
+    if ran is not None:
+        job_run_time.observe(ran, kind)
+    if timings:
+        _worker_timings.merge(timings)
+        for stage, entry in timings["stages"].items():
+            job_stage_time.observe(entry["seconds"], kind, stage)
+
+
+def render():
+    """Every metric in the Prometheus text exposition format"""
+    timings = Timings()
+    timings.merge(_worker_timings.summary())
+    timings.merge(process_timings.summary())
+    summary = timings.summary()
+
+    lines = []
+    for metric in (http_requests, http_duration, jobs_finished, job_queue_time, job_run_time, job_stage_time, *gauges):
+        lines.extend(metric.lines())
+
+    lines.append("# HELP netball_stage_duration_seconds Duration of single stage calls, e.g. one frame's pose inference")
+    lines.append("# TYPE netball_stage_duration_seconds histogram")
+    for stage, entry in sorted(summary["stages"].items()):
+        lines.extend(_histogram_lines("netball_stage_duration_seconds", ("stage",), (stage,), entry))
+
+    # Cache hit rates are hits / (hits + misses) of each cache
+    lines.append("# HELP netball_events_total Counted events such as cache hits and misses")
+    lines.append("# TYPE netball_events_total counter")
+    for event, value in sorted(summary["events"].items()):
+        lines.append(f"netball_events_total{_labels(('event',), (event,))} {value}")
+    return "\n".join(lines) + "\n"
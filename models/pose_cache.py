@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+import numpy as np
+
+
+LANDMARK_CACHE_DIR = os.environ.get("LANDMARK_CACHE_DIR", os.path.join(Path(__file__).parent, "cache", "landmarks"))
+LANDMARK_CACHE_MAX_MB = int(os.environ.get("LANDMARK_CACHE_MAX_MB", 1024))
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(content_hash, settings):
+    """Combine a video's content hash with the settings its landmarks were computed with"""
+    payload = json.dumps({"video": content_hash, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class LandmarkCache:
+    """
+    Content-addressed store of per-frame landmark arrays, one .npy file per key.
+    Entries are memory-mapped on read and the least recently used ones are
+    evicted once the directory grows past max_bytes. Writes go through a
+    temporary file and an atomic rename, so several worker processes can
+    share the same directory.
+    """
+
+    def __init__(self, directory=LANDMARK_CACHE_DIR, max_bytes=LANDMARK_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            landmarks = np.load(path, mmap_mode="r")
+            # Touch the entry so LRU eviction sees it as recently used
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return landmarks
+
+    def put(self, key, landmarks):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(landmarks, dtype=np.float32))
+        os.replace(temp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+landmark_cache = LandmarkCache()
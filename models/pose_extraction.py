@@ -0,0 +1,298 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import cv2
+import mediapipe as mp
+import numpy as np
+from mediapipe.framework.formats import landmark_pb2
+from inference import INFERENCE_MODES, MOTION_THRESHOLD, POSE_MODELS
+from pose_cache import cache_key, file_hash, landmark_cache
+from timing import count, stage
+from tracking import person_tracks, tracking_settings
+from video_io import read_frames
+
+
+NUM_LANDMARKS = 33
+POSE_SETTINGS = {"model_complexity": 1, "min_detection_confidence": 0.5, "min_tracking_confidence": 0.5}
+# Idle Pose estimators kept per settings; extract_landmarks_pair uses two at a time
+POSE_POOL_SIZE = int(os.environ.get("POSE_POOL_SIZE", 2))
+# Pose models every job worker initializes at startup (see warm_up)
+POSE_POOL_MODELS = [name for name in os.environ.get("POSE_POOL_MODELS", "lite,full").split(",") if name]
+# In multi-person mode pose runs on a region around the tracked player: the
+# previous pose's extent while it is still on the track, else the track's box,
+# grown by this fraction of its size on every side
+ROI_MARGIN = float(os.environ.get("POSE_ROI_MARGIN", 0.25))
+
+
+def pose_settings(model="full"):
+    """POSE_SETTINGS for one of inference.POSE_MODELS"""
+    return {**POSE_SETTINGS, "model_complexity": POSE_MODELS[model]}
+
+
+class PosePool:
+    """
+    Pre-initialized MediaPipe Pose estimators, kept per settings.
+
+    Building a Pose loads its graph and TFLite models, which costs more than
+    running it on a short clip. checkout() hands out an idle estimator (reset,
+    so no tracking state carries over from the previous video) or builds a new
+    one, and takes it back afterwards, keeping up to size idle per settings.
+    """
+
+    def __init__(self, size=POSE_POOL_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    @staticmethod
+    def _key(settings):
+        return tuple(sorted(settings.items()))
+
+    def _create(self, settings):
+        return mp.solutions.pose.Pose(**settings)
+
+    @contextmanager
+    def checkout(self, settings=POSE_SETTINGS):
+        key = self._key(settings)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            pose = idle.pop() if idle else None
+        if pose is None:
+            pose = self._create(settings)
+        else:
+            pose.reset()
+        try:
+            yield pose
+        except BaseException:
+            # The graph may be mid-run, don't hand it out again
+            pose.close()
+            raise
+        self._release(key, pose)
+
+    def _release(self, key, pose):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(pose)
+                return
+        pose.close()
+
+    def preload(self, settings, count=None):
+        """Build and warm up estimators for settings until count (default: size) are idle"""
+        key = self._key(settings)
+        with self._lock:
+            missing = (count or self.size) - len(self._idle.get(key, []))
+        blank = np.zeros((256, 256, 3), dtype=np.uint8)
+        for _ in range(missing):
+            pose = self._create(settings)
+            # The first process() call initializes the inference delegates
+            pose.process(blank)
+            self._release(key, pose)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for poses in idle.values():
+            for pose in poses:
+                pose.close()
+
+
+pose_pool = PosePool()
+
+
+def warm_up():
+    """Preload the pose pool with POSE_POOL_MODELS, called by each job worker as it starts"""
+    for model in POSE_POOL_MODELS:
+        try:
+            pose_pool.preload(pose_settings(model))
+        except Exception as e:
+            # Lite and heavy models are downloaded on first use and may not be available
+            print(f"Could not preload the {model} pose model: {e}")
+
+
+def landmarks_to_array(pose_landmarks):
+    """Convert MediaPipe pose landmarks to a (33, 4) array of x, y, z, visibility (all NaN when no pose)"""
+    if not pose_landmarks:
+        return np.full((NUM_LANDMARKS, 4), np.nan, dtype=np.float32)
+    return np.array([[lm.x, lm.y, lm.z, lm.visibility] for lm in pose_landmarks.landmark], dtype=np.float32)
+
+
+def array_to_landmarks(landmarks):
+    """Convert a (33, 4) landmark array back to MediaPipe landmarks for drawing, or None when no pose"""
+    if not has_pose(landmarks):
+        return None
+    return landmark_pb2.NormalizedLandmarkList(landmark=[
+        landmark_pb2.NormalizedLandmark(x=x, y=y, z=z, visibility=visibility)
+        for x, y, z, visibility in landmarks.tolist()
+    ])
+
+
+def has_pose(landmarks):
+    return not np.isnan(landmarks[0, 0])
+
+
+def _downscale(frame, max_side):
+    """Shrink a frame so its longer side is at most max_side pixels"""
+    height, width = frame.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return frame
+    scale = max_side / max(height, width)
+    return cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+def _thumbnail(frame):
+    return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (64, 64), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def _detect(pose, frame, max_side):
+    with stage("pose"):
+        image = cv2.cvtColor(_downscale(frame, max_side), cv2.COLOR_BGR2RGB)
+        image.flags.writeable = False
+        return landmarks_to_array(pose.process(image).pose_landmarks)
+
+
+def _person_roi(box, previous, margin=ROI_MARGIN):
+    """The (x1, y1, x2, y2) region, normalized to the frame, to run pose on for a tracked player"""
+    region = box
+    if previous is not None and has_pose(previous):
+        # Reuse the last pose's extent, which follows the player between detections
+        points = previous[previous[:, 3] > 0.5, :2]
+        if len(points):
+            center = points.mean(axis=0)
+            if box[0] <= center[0] <= box[2] and box[1] <= center[1] <= box[3]:
+                region = np.concatenate([points.min(axis=0), points.max(axis=0)])
+    size = region[2:] - region[:2]
+    return np.clip(np.concatenate([region[:2] - size * margin, region[2:] + size * margin]), 0, 1)
+
+
+def _detect_person(pose, frame, box, previous, max_side):
+    """Pose of the player in box (see tracking.py), as landmarks normalized to the whole frame"""
+    if np.isnan(box[0]):
+        return landmarks_to_array(None)
+    height, width = frame.shape[:2]
+    x1, y1, x2, y2 = (_person_roi(box, previous) * [width, height, width, height]).round().astype(int)
+    if x2 - x1 < 2 or y2 - y1 < 2:
+        return landmarks_to_array(None)
+    landmarks = _detect(pose, frame[y1:y2, x1:x2], max_side)
+    landmarks[:, 0] = (x1 + landmarks[:, 0] * (x2 - x1)) / width
+    landmarks[:, 1] = (y1 + landmarks[:, 1] * (y2 - y1)) / height
+    landmarks[:, 2] *= (x2 - x1) / width
+    return landmarks
+
+
+def interpolate_landmarks(landmarks, inferred):
+    """
+    Fill the frames that weren't inferred by linearly interpolating between
+    the nearest inferred frames on either side. The first and last frames must
+    be inferred. Frames next to an inferred frame without a pose stay NaN.
+    """
+    missing = np.flatnonzero(~inferred)
+    if len(missing) == 0:
+        return landmarks
+    known = np.flatnonzero(inferred)
+    after = known[np.searchsorted(known, missing)]
+    before = known[np.searchsorted(known, missing) - 1]
+    weight = ((missing - before) / (after - before)).astype(np.float32)[:, None, None]
+    landmarks[missing] = (1 - weight) * landmarks[before] + weight * landmarks[after]
+    return landmarks
+
+
+def detect_landmarks(frames, settings=POSE_SETTINGS, inference="full", boxes=None):
+    """
+    Run MediaPipe Pose over BGR frames and return a (frames, 33, 4) landmark array.
+    inference names one of inference.INFERENCE_MODES: pose runs on downscaled
+    frames, on every stride-th frame (or sooner when adaptive and the picture
+    moved), plus always the last one, and the rest are interpolated.
+    boxes, one track's column of tracking.person_tracks(), restricts pose to
+    the region of that player in each frame.
+    """
+    mode = INFERENCE_MODES[inference]
+    stride, max_side, adaptive = mode["stride"], mode["max_side"], mode["adaptive"]
+    rows = []
+    inferred = []
+    frame = last_thumbnail = previous = None
+
+    def detect(pose, frame, index):
+        if boxes is None:
+            return _detect(pose, frame, max_side)
+        return _detect_person(pose, frame, boxes[index], previous, max_side)
+
+    with pose_pool.checkout(settings) as pose:
+        skipped = stride  # so the first frame is always inferred
+        for index, frame in enumerate(frames):
+            run = skipped + 1 >= stride
+            if adaptive:
+                thumbnail = _thumbnail(frame)
+                run = run or np.abs(thumbnail - last_thumbnail).mean() > MOTION_THRESHOLD
+            if run:
+                rows.append(detect(pose, frame, index))
+                previous = rows[-1]
+                skipped = 0
+                if adaptive:
+                    last_thumbnail = thumbnail
+            else:
+                rows.append(None)
+                skipped += 1
+            inferred.append(run)
+        if rows and rows[-1] is None:
+            rows[-1] = detect(pose, frame, len(rows) - 1)
+            inferred[-1] = True
+
+    if not rows:
+        return np.empty((0, NUM_LANDMARKS, 4), dtype=np.float32)
+    empty = np.full((NUM_LANDMARKS, 4), np.nan, dtype=np.float32)
+    landmarks = np.stack([row if row is not None else empty for row in rows])
+    return interpolate_landmarks(landmarks, np.array(inferred))
+
+
+def landmark_cache_key(content_hash, settings=POSE_SETTINGS, inference="full", track=None):
+    params = {**settings, "mediapipe": mp.__version__}
+    if inference != "full":
+        # Keys for full inference stay as they were, so existing cache entries remain valid
+        params["inference"] = INFERENCE_MODES[inference]
+        if INFERENCE_MODES[inference]["adaptive"]:
+            params["motion_threshold"] = MOTION_THRESHOLD
+    if track is not None:
+        params.update({"track": track, "tracking": tracking_settings(), "roi_margin": ROI_MARGIN})
+    return cache_key(content_hash, params)
+
+
+def extract_landmarks(video_path, settings=POSE_SETTINGS, inference="full", track=None, content_hash=None):
+    """
+    Landmarks for every frame of a video.
+    Results are cached by the video's content hash, so a reference video that
+    is compared against many submissions only goes through pose inference once.
+    Pass content_hash when the caller already has it, to skip hashing the file.
+    track selects a player tracked by tracking.person_tracks() (None: the
+    video shows a single athlete).
+    """
+    content_hash = content_hash or file_hash(video_path)
+    key = landmark_cache_key(content_hash, settings, inference, track)
+    landmarks = landmark_cache.get(key)
+    if landmarks is not None:
+        count("landmark_cache_hit")
+        return landmarks
+    count("landmark_cache_miss")
+
+    boxes = person_tracks(video_path, content_hash)[:, track] if track is not None else None
+    landmarks = detect_landmarks(read_frames(video_path), settings, inference, boxes)
+    landmark_cache.put(key, landmarks)
+    return landmarks
+
+
+def extract_landmarks_pair(first_video_path, second_video_path, settings=POSE_SETTINGS, inference="full", tracks=(None, None),
+                           content_hashes=(None, None)):
+    """
+    Landmarks for two videos, extracted in parallel.
+    Each video gets its own worker and its own Pose instance, so the tracker
+    follows a single stream instead of re-detecting on every alternating frame.
+    MediaPipe and OpenCV release the GIL while decoding and running inference,
+    so the two threads use separate cores. tracks holds the track of each
+    video in multi-person mode (see extract_landmarks), content_hashes their
+    hashes when already known.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(extract_landmarks, first_video_path, settings, inference, tracks[0], content_hashes[0])
+        second = executor.submit(extract_landmarks, second_video_path, settings, inference, tracks[1], content_hashes[1])
+        return first.result(), second.result()
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import urlsplit
+from s3_download import probe_s3_file
+from timing import count
+
+
+# Finished analyses by (endpoint, content hashes of both videos, parameters),
+# so a resubmitted comparison returns the stored video URL and scores instead
+# of running again. Entries expire after RESULT_CACHE_TTL seconds (keep it
+# below the bucket's retention of output videos) and the least recently used
+# ones are evicted past RESULT_CACHE_MAX_MB.
+RESULT_CACHE_ENABLED = os.environ.get("RESULT_CACHE_ENABLED", "1") == "1"
+# sqlite (default) or disk, see RESULT_CACHE_BACKENDS
+RESULT_CACHE_BACKEND = os.environ.get("RESULT_CACHE_BACKEND", "sqlite")
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", os.path.join(Path(__file__).parent, "cache", "results"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 24 * 3600))
+RESULT_CACHE_MAX_MB = int(os.environ.get("RESULT_CACHE_MAX_MB", 64))
+# Bump when a change to the pipelines makes stored results stale
+RESULT_VERSION = 1
+
+
+class SQLiteResultCache:
+    """
+    JSON values in a SQLite database. Each thread gets its own connection and
+    WAL mode lets the job worker processes read while one of them writes.
+    """
+
+    def __init__(self, directory=RESULT_CACHE_DIR, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024):
+        self.path = os.path.join(directory, "results.sqlite3")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > self.ttl:
+            self.delete(key)
+            return None
+        connection.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        data = json.dumps(value)
+        now = time.time()
+        self._connection().execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", (key, data, len(data), now, now))
+        self.evict()
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones until the cache fits in max_bytes"""
+        connection = self._connection()
+        connection.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in connection.execute("SELECT key, size FROM results ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.delete(key)
+            total -= size
+
+
+class DiskResultCache:
+    """One JSON file per entry, written like pose_cache.LandmarkCache's (temporary file and rename)"""
+
+    def __init__(self, directory=RESULT_CACHE_DIR, ttl=RESULT_CACHE_TTL, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry["created_at"] > self.ttl:
+            self.delete(key)
+            return None
+        # The modification time orders entries for LRU eviction
+        os.utime(path)
+        return entry["value"]
+
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"created_at": time.time(), "value": value}, f)
+        os.replace(temp_path, self._path(key))
+        self.evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in sorted(entries):
+            # Not read for a whole TTL means expired, whatever its creation time
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# A backend is any class with get(key), put(key, value) and delete(key) that
+# takes (directory, ttl, max_bytes); values are JSON-serializable dicts
+RESULT_CACHE_BACKENDS = {"sqlite": SQLiteResultCache, "disk": DiskResultCache}
+
+result_cache = RESULT_CACHE_BACKENDS[RESULT_CACHE_BACKEND]()
+
+
+def _digest(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _source_key(url, probe):
+    # The query string is left out: presigned URLs of the same object differ in it
+    parts = urlsplit(url)
+    return "source_" + _digest({"url": f"{parts.scheme}://{parts.netloc}{parts.path}", "etag": probe[0], "size": probe[1]})
+
+
+class ResultLookup:
+    """
+    Cache lookups for one analysis request of endpoint `kind` on the videos at
+    urls, with params holding every parameter that changes its result.
+
+    The content hashes of videos seen before are remembered by URL, ETag and
+    size, so a resubmission is answered from the cache without downloading
+    anything: check result after creating the lookup. Otherwise download the
+    videos and call check_hashes() with their content hashes. After a miss,
+    store() saves the response for the next time. source_hashes holds the
+    remembered hash of each URL (None when unknown) even when the result
+    isn't cached, so ingest can reuse cached landmarks.
+    """
+
+    def __init__(self, kind, urls, params):
+        self.kind = kind
+        self.urls = urls
+        self.params = params
+        self.hashes = None
+        self.probes = None
+        self.source_hashes = [None] * len(urls)
+        self.result = None
+        if not RESULT_CACHE_ENABLED:
+            return
+        self.probes = [probe_s3_file(url) for url in urls]
+        entries = [self._get(_source_key(url, probe)) if probe else None for url, probe in zip(urls, self.probes)]
+        self.source_hashes = [entry["sha256"] if entry else None for entry in entries]
+        if all(self.source_hashes):
+            self.hashes = list(self.source_hashes)
+            self.result = self._lookup()
+            if self.result is not None:
+                count("result_cache_hit")
+
+    def _get(self, key):
+        try:
+            return result_cache.get(key)
+        except Exception as e:
+            print(f"Result cache lookup failed: {e}")
+            return None
+
+    def _put(self, key, value):
+        try:
+            result_cache.put(key, value)
+        except Exception as e:
+            print(f"Could not write to the result cache: {e}")
+
+    def _key(self):
+        return "result_" + _digest({"kind": self.kind, "inputs": self.hashes, "params": self.params, "version": RESULT_VERSION})
+
+    def _lookup(self):
+        entry = self._get(self._key())
+        if entry is None:
+            return None
+        if entry.get("video_key"):
+            # The video may have been removed from the bucket since
+            from storage import object_exists
+            try:
+                if not object_exists(entry["video_key"]):
+                    result_cache.delete(self._key())
+                    return None
+            except Exception as e:
+                print(f"Could not check the cached video {entry['video_key']}: {e}")
+                return None
+        return {**entry["result"], "cached": True}
+
+    def check_hashes(self, hashes):
+        """Look the request up by the content hashes of the downloaded videos; returns the cached result or None"""
+        if not RESULT_CACHE_ENABLED:
+            return None
+        self.hashes = list(hashes)
+        # Only remember a URL's hash when the object didn't change during the download
+        for url, probe, content_hash in zip(self.urls, self.probes, self.hashes):
+            if probe is not None and probe_s3_file(url) == probe:
+                self._put(_source_key(url, probe), {"sha256": content_hash})
+        self.result = self._lookup()
+        count("result_cache_hit" if self.result is not None else "result_cache_miss")
+        return self.result
+
+    def store(self, result, video_key=None):
+        """Save a computed result; video_key is the bucket key of its video, checked on every hit"""
+        if RESULT_CACHE_ENABLED and self.hashes is not None:
+            self._put(self._key(), {"result": result, "video_key": video_key})
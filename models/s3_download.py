@@ -1,22 +1,231 @@
-import requests
+import hashlib
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from timing import stage
 
-def download_s3_file(url, output_path):
 
+DOWNLOAD_CONNECT_TIMEOUT = float(os.environ.get("DOWNLOAD_CONNECT_TIMEOUT", 5))
+DOWNLOAD_READ_TIMEOUT = float(os.environ.get("DOWNLOAD_READ_TIMEOUT", 60))
+DOWNLOAD_RETRIES = int(os.environ.get("DOWNLOAD_RETRIES", 3))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", 4))
+# Files at least this large are fetched as parallel byte ranges
+DOWNLOAD_MULTIPART_THRESHOLD = int(os.environ.get("DOWNLOAD_MULTIPART_THRESHOLD", 16 * 1024 * 1024))
+DOWNLOAD_PART_SIZE = int(os.environ.get("DOWNLOAD_PART_SIZE", 8 * 1024 * 1024))
+
+CHUNK_SIZE = 1024 * 1024
+MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})"?$')
+
+
+class DownloadError(Exception):
+    """A download failed or arrived incomplete; also raised by the pipelines when an input can't be fetched"""
+
+
+class RangesIgnored(Exception):
+    """The server answered a range request with the whole object"""
+
+
+def _create_session():
+    # No adapter-level retries: every request is retried once, by _with_retries below
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=DOWNLOAD_CONCURRENCY * 2)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+session = _create_session()
+TIMEOUT = (DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+
+
+def is_client_error(error):
+    """Whether a download failed with a 4xx response, which retrying won't change"""
+    response = getattr(error, "response", None)
+    return response is not None and 400 <= response.status_code < 500
+
+
+def redact_url(url):
+    """url without its query string, which holds the signature of presigned URLs, for logs and errors"""
+    return url.split("?")[0]
+
+
+def describe_error(error, url):
+    """An error's message for the logs, with url redacted (requests includes it in HTTP errors)"""
+    return str(error).replace(url, redact_url(url))
+
+
+def _with_retries(fn, *args):
+    """Call fn, retrying network failures and 5xx responses with exponential backoff (4xx responses are not retried)"""
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            return fn(*args)
+        except (requests.exceptions.RequestException, DownloadError) as e:
+            if attempt == DOWNLOAD_RETRIES or is_client_error(e):
+                raise
+            delay = 0.5 * 2 ** attempt
+            print(f"Download attempt {attempt + 1} failed ({describe_error(e, args[0])}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _expected_md5(headers):
+    """The object's MD5 when its ETag is one (single part upload without SSE-KMS), else None"""
+    if headers.get("x-amz-server-side-encryption") == "aws:kms":
+        return None
+    match = MD5_ETAG.match(headers.get("ETag", ""))
+    return match.group(1) if match else None
+
+
+def _verify(output_path, expected_size, expected_md5, md5=None):
+    actual_size = os.path.getsize(output_path)
+    if expected_size is not None and actual_size != expected_size:
+        raise DownloadError(f"Expected {expected_size} bytes but received {actual_size}")
+    if expected_md5 is not None:
+        if md5 is None:
+            md5 = hashlib.md5()
+            with open(output_path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    md5.update(chunk)
+        if md5.hexdigest() != expected_md5:
+            raise DownloadError("Checksum mismatch: downloaded content does not match the object's ETag")
+
+
+def _content_length_header(headers):
+    size = headers.get("Content-Length")
+    return int(size) if size is not None and "Content-Encoding" not in headers else None
+
+
+def _content_length(response):
+    return _content_length_header(response.headers)
+
+
+def _write_stream(response, output_path, on_chunk=None):
+    md5 = hashlib.md5()
+    with open(output_path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            if chunk:
+                f.write(chunk)
+                md5.update(chunk)
+                if on_chunk is not None:
+                    on_chunk(chunk)
+    return md5
+
+
+def _download_part(url, output_path, start, end):
+    headers = {"Range": f"bytes={start}-{end}"}
+    with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangesIgnored(f"Server ignored range request for bytes {start}-{end}")
+        fd = os.open(output_path, os.O_WRONLY)
+        try:
+            offset = start
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+        finally:
+            os.close(fd)
+    if offset != end + 1:
+        raise DownloadError(f"Range {start}-{end} ended early at byte {offset}")
+
+
+def _download_multipart(url, output_path, headers):
+    """Fetch url as parallel byte ranges, each retried on its own. Raises RangesIgnored if the server sends a 200 instead"""
+    size = _content_length_header(headers)
+    with open(output_path, "wb") as f:
+        f.truncate(size)
+
+    ranges = [(start, min(start + DOWNLOAD_PART_SIZE, size) - 1) for start in range(0, size, DOWNLOAD_PART_SIZE)]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        futures = [executor.submit(_with_retries, _download_part, url, output_path, start, end) for start, end in ranges]
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    _verify(output_path, size, _expected_md5(headers))
+
+
+def _download(url, output_path, allow_ranges=True):
+    """
+    Stream url into output_path with one GET. When the object is large enough to
+    fetch as parallel ranges, return its headers instead without reading the body.
+    """
+    with session.get(url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        size = _content_length(response)
+
+        if allow_ranges and size is not None and size >= DOWNLOAD_MULTIPART_THRESHOLD and response.headers.get("Accept-Ranges") == "bytes":
+            return response.headers
+
+        md5 = _write_stream(response, output_path)
+        _verify(output_path, size, _expected_md5(response.headers), md5)
+        return None
+
+
+def download_s3_file(url, output_path):
+    """
+    Download url to output_path. Large files are fetched as parallel byte ranges,
+    each request is retried with backoff, and the result is checked against the
+    Content-Length and (when it is an MD5) the ETag. Returns True on success.
+    """
     try:
-        
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  
-        
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    
+        with stage("download"):
+            headers = _with_retries(_download, url, output_path)
+            if headers is not None:
+                try:
+                    _download_multipart(url, output_path, headers)
+                except RangesIgnored as e:
+                    # Advertised ranges but sent the whole object; retrying a range won't help
+                    print(f"{e} for {redact_url(url)}, downloading it with a single request")
+                    _with_retries(_download, url, output_path, False)
         return True
-        
-    except requests.exceptions.RequestException as e:
-        print(f"Error downloading file: {e}")
-        return False
\ No newline at end of file
+
+    except (requests.exceptions.RequestException, DownloadError, OSError) as e:
+        print(f"Error downloading {redact_url(url)}: {describe_error(e, url)}")
+        return False
+
+
+def download_s3_files(downloads):
+    """Download several (url, output_path) pairs concurrently and return a success flag for each"""
+    with ThreadPoolExecutor(max_workers=max(1, min(len(downloads), DOWNLOAD_CONCURRENCY))) as executor:
+        return list(executor.map(lambda item: download_s3_file(*item), downloads))
+
+
+def stream_s3_file(url, output_path, on_chunk):
+    """
+    Download url to output_path with one sequential request, passing every chunk
+    to on_chunk as soon as it arrives. Unlike download_s3_file this is not retried
+    (on_chunk has already seen the partial data) and raises on failure.
+    """
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Includes the time on_chunk takes, e.g. waiting for pose extraction to keep up
+    with stage("download"), session.get(url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        md5 = _write_stream(response, output_path, on_chunk)
+        _verify(output_path, _content_length(response), _expected_md5(response.headers), md5)
+
+
+def probe_s3_file(url):
+    """
+    The (ETag, size) of the object at url, read from a one byte ranged GET
+    (unlike HEAD this also works with presigned GET URLs). None when the
+    request fails or the server sends no ETag.
+    """
+    try:
+        with session.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            etag = response.headers.get("ETag")
+            content_range = response.headers.get("Content-Range", "")
+            size = int(content_range.rsplit("/", 1)[1]) if "/" in content_range and not content_range.endswith("*") else _content_length(response)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Could not probe {redact_url(url)}: {describe_error(e, url)}")
+        return None
+    return (etag, size) if etag else None
@@ -0,0 +1,166 @@
+import math
+import os
+import numpy as np
+
+
+SCORING_METHODS = ("cosine", "correlation", "dtw")
+# Sakoe-Chiba band as a fraction of the longer clip, capped at DTW_MAX_WINDOW frames
+DTW_BAND = float(os.environ.get("DTW_BAND", 0.1))
+DTW_MAX_WINDOW = int(os.environ.get("DTW_MAX_WINDOW", 300))
+
+
+def cosine_similarity(a, b):
+    """
+    Cosine similarity of two series, truncating the longer one.
+    Angles are all positive, so this stays high for most pairs of movements.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    length = min(len(a), len(b))
+    a, b = a[:length], b[:length]
+    if np.all(a == 0) or np.all(b == 0):
+        return 0  # Handle all-zero vectors
+    # Same computation as 1 - scipy.spatial.distance.cosine
+    return 1 - np.clip(1.0 - np.dot(a, b) / math.sqrt(np.dot(a, a) * np.dot(b, b)), 0.0, 2.0)
+
+
+def correlation_similarity(a, b):
+    """
+    Pearson correlation of two series, truncating the longer one, clipped at 0.
+    Compares the shape of the movement rather than absolute angles: a constant
+    offset or scale doesn't change it, opposite movement scores 0.
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    length = min(len(a), len(b))
+    if length == 0:
+        return 0.0
+    a = a[:length] - a[:length].mean()
+    b = b[:length] - b[:length].mean()
+    aa, bb = np.dot(a, a), np.dot(b, b)
+    if aa == 0 or bb == 0:
+        # A flat series only matches another flat series
+        return 1.0 if aa == bb else 0.0
+    return max(0.0, float(np.dot(a, b) / math.sqrt(aa * bb)))
+
+
+def metric_similarity(a, b, method="cosine"):
+    """Similarity (0-1) of two series that have already been paired up by align()"""
+    if method == "cosine":
+        return cosine_similarity(a, b)
+    return correlation_similarity(a, b)
+
+
+def _band_values(row, row_start, start, stop):
+    """Values of a banded cost-matrix row at columns start..stop-1 (inf outside its band)"""
+    values = np.full(stop - start, np.inf)
+    lo = max(start, row_start)
+    hi = min(stop, row_start + len(row))
+    if lo < hi:
+        values[lo - start:hi - start] = row[lo - row_start:hi - row_start]
+    return values
+
+
+def dtw(x, y, band=DTW_BAND):
+    """
+    Dynamic time warping between two (frames, features) sequences.
+
+    The warping path is restricted to a Sakoe-Chiba band around the diagonal
+    (scaled for clips of different length), and only the band of each row of
+    the cost matrix is kept, so time and memory are O(n * w) instead of
+    O(n * m). Each row is filled with a handful of numpy operations: with
+    a = min(D[i-1, j-1], D[i-1, j]) and C the running sum of the row's costs,
+    D[i, j] = C[j] + min over k <= j of (a[k] - C[k-1]), a running minimum.
+
+    Returns (average cost per path step, path) where path is a (steps, 2)
+    array of index pairs into x and y.
+    """
+    n, m = len(x), len(y)
+    if n == 0 or m == 0:
+        return np.inf, np.empty((0, 2), dtype=int)
+
+    slope = (m - 1) / (n - 1) if n > 1 else 0
+    width = min(int(band * max(n, m)), DTW_MAX_WINDOW)
+    # Wide enough that consecutive rows' bands overlap
+    width = max(width, math.ceil(slope), 1)
+
+    starts = np.empty(n, dtype=int)
+    rows = []
+    for i in range(n):
+        center = i * slope if n > 1 else m - 1
+        start = max(0, math.floor(center - width))
+        stop = min(m, math.ceil(center + width) + 1)
+        if i == 0:
+            start = 0
+        if i == n - 1:
+            stop = m
+        cost = np.linalg.norm(y[start:stop] - x[i], axis=1)
+        cumulative = np.cumsum(cost)
+        if i == 0:
+            row = cumulative
+        else:
+            previous, previous_start = rows[-1], starts[i - 1]
+            best = np.minimum(_band_values(previous, previous_start, start, stop),
+                              _band_values(previous, previous_start, start - 1, stop - 1))
+            row = cumulative + np.minimum.accumulate(best - (cumulative - cost))
+        starts[i] = start
+        rows.append(row)
+
+    def value(i, j):
+        offset = j - starts[i]
+        return rows[i][offset] if 0 <= offset < len(rows[i]) else np.inf
+
+    # Walk back from the end, preferring diagonal steps on ties
+    i, j = n - 1, m - 1
+    path = [(i, j)]
+    while i > 0 or j > 0:
+        steps = []
+        if i > 0 and j > 0:
+            steps.append((value(i - 1, j - 1), i - 1, j - 1))
+        if i > 0:
+            steps.append((value(i - 1, j), i - 1, j))
+        if j > 0:
+            steps.append((value(i, j - 1), i, j - 1))
+        _, i, j = min(steps, key=lambda step: step[0])
+        path.append((i, j))
+
+    path = np.array(path[::-1], dtype=int)
+    return value(n - 1, m - 1) / len(path), path
+
+
+def _features(series, names):
+    """z-normalized metrics as a (frames, metrics) array, so every metric weighs the same in DTW"""
+    columns = []
+    for name in names:
+        column = np.asarray(series[name], dtype=float)
+        std = column.std() if len(column) else 0
+        columns.append((column - column.mean()) / std if std > 0 else np.zeros_like(column))
+    return np.stack(columns, axis=1)
+
+
+def align(correct, incorrect, names, method="cosine", band=DTW_BAND):
+    """
+    Pair up the frames of two MetricSeries for scoring.
+
+    cosine and correlation compare frame by frame: the frames where both
+    videos have a pose, truncated to the shorter clip. dtw pairs the frames
+    with a pose in each video by motion phase, aligning all the named metrics
+    together, so a late start or a slower movement isn't scored as a mismatch.
+
+    Returns (correct rows, incorrect rows, alignment): two MetricSeries of
+    equal length and a (steps, 2) array of the source frame numbers paired.
+    """
+    if method not in SCORING_METHODS:
+        raise ValueError(f"Unknown scoring method '{method}', expected one of {SCORING_METHODS}")
+
+    if method == "dtw":
+        correct, incorrect = correct.detected(), incorrect.detected()
+        _, path = dtw(_features(correct, names), _features(incorrect, names), band)
+        correct, incorrect = correct.select(path[:, 0]), incorrect.select(path[:, 1])
+    else:
+        length = min(len(correct), len(incorrect))
+        correct, incorrect = correct[:length], incorrect[:length]
+        both_detected = correct.valid & incorrect.valid
+        correct, incorrect = correct.select(both_detected), incorrect.select(both_detected)
+
+    return correct, incorrect, np.stack([correct.frames, incorrect.frames], axis=1)
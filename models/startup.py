@@ -0,0 +1,54 @@
+import os
+import threading
+import time
+import traceback
+
+
+WARMUP_ON_STARTUP = os.environ.get("WARMUP_ON_STARTUP", "1") == "1"
+
+PENDING = "pending"
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+_lock = threading.Lock()
+_components = {}
+
+
+def _run(name, fn):
+    with _lock:
+        _components[name].update(status=LOADING, started_at=time.time())
+    start = time.perf_counter()
+    try:
+        fn()
+        status, error = READY, None
+    except Exception as e:
+        status, error = FAILED, f"{type(e).__name__}: {e}"
+        print(f"Warm-up of {name} failed")
+        traceback.print_exc()
+    seconds = round(time.perf_counter() - start, 3)
+    print(f"Warm-up of {name}: {status} in {seconds}s")
+    with _lock:
+        _components[name].update(status=status, seconds=seconds, error=error)
+
+
+def start_warmup(steps):
+    """
+    Run each warm-up step (name -> zero-argument callable) on its own
+    background thread, so they load in parallel while the server is already
+    accepting requests. Progress is reported by readiness().
+    """
+    for name, fn in steps.items():
+        with _lock:
+            _components[name] = {"status": PENDING, "started_at": None, "seconds": None, "error": None}
+        threading.Thread(target=_run, args=(name, fn), name=f"warmup-{name}", daemon=True).start()
+
+
+def readiness():
+    """Whether every warm-up step has finished successfully, with per-step status and timings"""
+    with _lock:
+        components = {name: dict(state) for name, state in _components.items()}
+    return {
+        "ready": all(state["status"] == READY for state in components.values()),
+        "components": components,
+    }
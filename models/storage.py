@@ -0,0 +1,213 @@
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from jobs import report_progress
+from timing import stage
+
+
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+AWS_ACCESS_KEY = os.environ.get("AWS_ACCESS_KEY")
+AWS_SECRET_KEY = os.environ.get("AWS_SECRET_KEY")
+# Point at an S3-compatible server instead of AWS, e.g. MinIO or `moto_server`
+# for local testing (http://localhost:9000). URLs are then path-style.
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
+
+# Multipart upload tuning: part size (S3's minimum is 5 MB) and parts in flight
+UPLOAD_PART_SIZE = int(os.environ.get("UPLOAD_PART_SIZE_MB", 8)) * 1024 * 1024
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 4))
+# Upload output videos while they are encoded rather than after
+STREAMING_UPLOAD = os.environ.get("STREAMING_UPLOAD", "1") == "1"
+
+
+_s3_client = None
+_client_lock = threading.Lock()
+
+def get_s3_client():
+    # boto3 is imported on first use, it adds noticeably to startup time
+    global _s3_client
+    with _client_lock:
+        if _s3_client is None:
+            import boto3
+            from botocore.config import Config
+            _s3_client = boto3.client(
+                "s3",
+                aws_access_key_id=AWS_ACCESS_KEY,
+                aws_secret_access_key=AWS_SECRET_KEY,
+                endpoint_url=S3_ENDPOINT_URL,
+                config=Config(retries={"max_attempts": 5, "mode": "standard"},
+                              max_pool_connections=max(10, UPLOAD_CONCURRENCY * 2),
+                              s3={"addressing_style": "path"} if S3_ENDPOINT_URL else None),
+            )
+    return _s3_client
+
+
+def object_url(key):
+    if S3_ENDPOINT_URL:
+        return f"{S3_ENDPOINT_URL.rstrip('/')}/{S3_BUCKET_NAME}/{key}"
+    return f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{key}"
+
+
+def _transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=UPLOAD_PART_SIZE, multipart_chunksize=UPLOAD_PART_SIZE,
+                          max_concurrency=UPLOAD_CONCURRENCY, use_threads=True)
+
+
+def upload_file(path, key):
+    """Upload a local file to the bucket (in parallel parts when large) and return its URL"""
+    total = os.path.getsize(path)
+    uploaded = [0]
+    lock = threading.Lock()
+
+    def progress(count):
+        with lock:
+            uploaded[0] += count
+            report_progress(upload_bytes=uploaded[0], upload_total=total)
+
+    with stage("upload"):
+        get_s3_client().upload_file(path, S3_BUCKET_NAME, key, Config=_transfer_config(), Callback=progress)
+    return object_url(key)
+
+
+def download_file(key, path):
+    get_s3_client().download_file(S3_BUCKET_NAME, key, path, Config=_transfer_config())
+
+
+def is_missing(error):
+    """Whether a botocore ClientError says the object doesn't exist"""
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+def object_exists(key):
+    from botocore.exceptions import ClientError
+    try:
+        get_s3_client().head_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return True
+    except ClientError as e:
+        if is_missing(e):
+            return False
+        raise
+
+
+class MultipartUpload:
+    """
+    Upload a stream to the bucket while it is being produced.
+
+    Bytes passed to write() are cut into parts of part_size, which upload on a
+    thread pool while more data arrives, so the upload finishes shortly after
+    the last byte is written. At most twice `concurrency` parts are held in
+    memory: write() blocks when the uploads fall behind. complete() sends the
+    remainder and assembles the object; abort() discards the uploaded parts,
+    and is called by complete() itself when a part failed.
+    """
+
+    def __init__(self, key, part_size=UPLOAD_PART_SIZE, concurrency=UPLOAD_CONCURRENCY, content_type="video/mp4"):
+        self.key = key
+        self.part_size = part_size
+        self.client = get_s3_client()
+        self.upload_id = self.client.create_multipart_upload(Bucket=S3_BUCKET_NAME, Key=key, ContentType=content_type)["UploadId"]
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(concurrency * 2)
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_uploaded = 0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def _submit(self, body):
+        # Fail fast instead of encoding the rest of the video for nothing
+        for part in self.parts:
+            if part.done() and part.exception() is not None:
+                raise part.exception()
+        self.slots.acquire()
+        self.parts.append(self.executor.submit(self._upload_part, len(self.parts) + 1, body))
+
+    def _upload_part(self, number, body):
+        try:
+            with stage("upload"):
+                response = self.client.upload_part(Bucket=S3_BUCKET_NAME, Key=self.key, UploadId=self.upload_id,
+                                                   PartNumber=number, Body=body)
+            with self.lock:
+                self.bytes_uploaded += len(body)
+                report_progress(upload_bytes=self.bytes_uploaded, upload_parts=number)
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            self.slots.release()
+
+    def complete(self):
+        """Upload what is left, assemble the object and return its URL"""
+        try:
+            if self.buffer or not self.parts:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [part.result() for part in self.parts]
+            with stage("upload"):
+                self.client.complete_multipart_upload(Bucket=S3_BUCKET_NAME, Key=self.key, UploadId=self.upload_id,
+                                                      MultipartUpload={"Parts": parts})
+        except BaseException:
+            self.abort()
+            raise
+        self.executor.shutdown()
+        return object_url(self.key)
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        try:
+            self.client.abort_multipart_upload(Bucket=S3_BUCKET_NAME, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            print(f"Could not abort the upload of {self.key}: {e}")
+
+
+class VideoUpload:
+    """
+    Where an analysis writes its output video, and the video's URL afterwards.
+
+    output is what to pass to the analysis as its output_path: a
+    MultipartUpload that the encoder streams into while STREAMING_UPLOAD is
+    on, or a local file in the workspace that is uploaded once it's written.
+    """
+
+    def __init__(self, workspace, key=None):
+        self.key = key or f"{uuid.uuid4()}_analysis.mp4"
+        self.url = None
+        if STREAMING_UPLOAD:
+            self.output = MultipartUpload(self.key)
+        else:
+            self.output = workspace.path("output", "analysis.mp4")
+
+    def finish(self):
+        if isinstance(self.output, MultipartUpload):
+            self.url = self.output.complete()
+        else:
+            self.url = upload_file(self.output, self.key)
+        return self.url
+
+    def abort(self):
+        if isinstance(self.output, MultipartUpload):
+            self.output.abort()
+
+
+@contextmanager
+def video_upload(workspace, key=None, enabled=True):
+    """
+    Yield a VideoUpload for an analysis to write its video to, finishing the
+    upload when the block completes and aborting it if the block raises.
+    Yields None when enabled is False (nothing is rendered).
+    """
+    if not enabled:
+        yield None
+        return
+    upload = VideoUpload(workspace, key)
+    try:
+        yield upload
+    except BaseException:
+        upload.abort()
+        raise
+    upload.finish()
@@ -0,0 +1,131 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from pose_cache import file_hash, landmark_cache
+from pose_extraction import POSE_SETTINGS, detect_landmarks, landmark_cache_key
+from s3_download import DownloadError, describe_error, download_s3_file, is_client_error, redact_url, stream_s3_file
+from timing import count
+from video_io import StreamingDecoder, is_streamable_mp4
+
+
+STREAMING_INGEST = os.environ.get("STREAMING_INGEST", "1") == "1"
+# Give up on streaming if the moov box hasn't shown up within this many bytes
+STREAMING_PROBE_LIMIT = int(os.environ.get("STREAMING_PROBE_LIMIT", 4 * 1024 * 1024))
+
+
+class StreamingIngest:
+    """
+    Runs pose extraction on a video while it downloads.
+
+    Chunks are hashed as they arrive and, once the file's first boxes show the
+    MP4 can be decoded from the front, piped into a StreamingDecoder whose frames
+    go straight to MediaPipe on a worker thread. Files that can't be streamed
+    (mdat before moov, not an MP4) are simply downloaded.
+    """
+
+    def __init__(self, settings=POSE_SETTINGS, inference="full"):
+        self.settings = settings
+        self.inference = inference
+        self.digest = hashlib.sha256()
+        self.header = b""
+        self.streamable = None
+        self.decoder = None
+        self.executor = None
+        self.landmarks = None
+
+    def feed(self, chunk):
+        self.digest.update(chunk)
+        if self.decoder is not None:
+            self.decoder.feed(chunk)
+        elif self.streamable is None:
+            self.header += chunk
+            self.streamable = is_streamable_mp4(self.header)
+            if self.streamable is None and len(self.header) > STREAMING_PROBE_LIMIT:
+                self.streamable = False
+            if self.streamable:
+                self._start(self.header)
+            if self.streamable is not None:
+                self.header = b""
+
+    def _start(self, header):
+        self.decoder = StreamingDecoder()
+        self.decoder.feed(header)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.landmarks = self.executor.submit(detect_landmarks, self.decoder.frames(), self.settings, self.inference)
+
+    def finish(self):
+        """Wait for extraction to catch up with the completed download and return its landmarks, or None"""
+        if self.decoder is None:
+            return None
+        self.decoder.finish()
+        try:
+            landmarks = self.landmarks.result()
+            self.decoder.close()
+            return landmarks
+        except Exception as e:
+            print(f"Streaming pose extraction failed, landmarks will be extracted from the file: {e}")
+            self.abort()
+            return None
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def abort(self):
+        if self.decoder is not None:
+            self.decoder.kill()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    @property
+    def content_hash(self):
+        return self.digest.hexdigest()
+
+
+def ingest_video(url, output_path, settings=POSE_SETTINGS, inference="full", known_hash=None):
+    """
+    Download a video to output_path, extracting its pose landmarks into the
+    landmark cache while it downloads when the file allows it, so analysis
+    can start as soon as the last byte arrives. known_hash is the content
+    hash the video at url had when it was last downloaded (see
+    result_cache.ResultLookup.source_hashes): when its landmarks are cached
+    already, the video is just downloaded. Returns the SHA-256 of the
+    video's content (see pose_cache.file_hash), or None when it couldn't be
+    downloaded.
+    """
+    if not STREAMING_INGEST:
+        return _download(url, output_path)
+    if known_hash and landmark_cache.get(landmark_cache_key(known_hash, settings, inference)) is not None:
+        count("landmarks_cached_at_ingest")
+        return _download(url, output_path)
+
+    ingest = StreamingIngest(settings, inference)
+    try:
+        stream_s3_file(url, output_path, ingest.feed)
+    except (requests.exceptions.RequestException, DownloadError, OSError) as e:
+        ingest.abort()
+        message = describe_error(e, url)
+        if is_client_error(e):
+            print(f"Could not download {redact_url(url)}: {message}")
+            return None
+        print(f"Streaming download of {redact_url(url)} failed ({message}), retrying as a plain download")
+        return _download(url, output_path)
+
+    landmarks = ingest.finish()
+    if landmarks is not None:
+        landmark_cache.put(landmark_cache_key(ingest.content_hash, settings, inference), landmarks)
+        count("landmarks_streamed")
+    return ingest.content_hash
+
+
+def _download(url, output_path):
+    return file_hash(output_path) if download_s3_file(url, output_path) else None
+
+
+def ingest_videos(downloads, settings=POSE_SETTINGS, inference="full", known_hashes=None):
+    """
+    Ingest several (url, output_path) pairs concurrently and return each one's
+    content hash (None: failed); known_hashes as for ingest_video, one per pair.
+    """
+    known_hashes = known_hashes or [None] * len(downloads)
+    with ThreadPoolExecutor(max_workers=max(1, len(downloads))) as executor:
+        return list(executor.map(lambda item: ingest_video(*item[0], settings, inference, item[1]), zip(downloads, known_hashes)))
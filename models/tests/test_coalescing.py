@@ -0,0 +1,175 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import controller
+import jobs
+
+
+calls = []
+release = threading.Event()
+
+
+def slow_job(value, fail=False):
+    """Stands in for an analysis pipeline: counts its calls and blocks until released"""
+    calls.append(value)
+    release.wait(5)
+    if fail:
+        raise ValueError(f"bad input {value}")
+    return {"value": value}
+
+
+@pytest.fixture
+def job_pool(monkeypatch):
+    # Threads instead of worker processes, so no pipeline modules get imported
+    executor = ThreadPoolExecutor(max_workers=4)
+    monkeypatch.setattr(jobs, "_get_executor", lambda: executor)
+    monkeypatch.setattr(jobs, "_progress", {})
+    monkeypatch.setattr(jobs, "_jobs", {})
+    monkeypatch.setattr(jobs, "_inflight", {})
+    monkeypatch.setattr(jobs, "JOB_COALESCE", True)
+    calls.clear()
+    release.clear()
+    yield
+    release.set()
+    executor.shutdown(wait=True)
+
+
+async def _submit_together(count, *args, **kwargs):
+    waiters = [asyncio.ensure_future(jobs.run_job("test", slow_job, *args, **kwargs)) for _ in range(count)]
+    while not calls:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+    release.set()
+    return await asyncio.gather(*waiters, return_exceptions=True)
+
+
+def test_identical_jobs_share_one_execution(job_pool):
+    results = asyncio.run(_submit_together(5, 21))
+    assert calls == [21]
+    assert results == [{"value": 21}] * 5
+    job, = jobs._jobs.values()
+    assert job["requests"] == 5
+    assert jobs._inflight == {}
+
+
+def test_cancelled_waiter_leaves_the_job_to_the_others(job_pool, monkeypatch):
+    # One worker, kept busy so the shared job is still queued when a waiter goes away
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(jobs, "_get_executor", lambda: executor)
+
+    async def scenario():
+        blocker = jobs.submit_job("test", slow_job, 0)
+        first = asyncio.ensure_future(jobs.run_job("test", slow_job, 9))
+        second = asyncio.ensure_future(jobs.run_job("test", slow_job, 9))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        await jobs.wait_for_job(blocker)
+        return first, await second
+
+    try:
+        first, result = asyncio.run(scenario())
+    finally:
+        release.set()
+        executor.shutdown(wait=True)
+    assert first.cancelled()
+    assert result == {"value": 9}
+    assert calls == [0, 9]
+    assert all(job["status"] == jobs.DONE for job in jobs._jobs.values())
+
+
+def test_job_cancelled_in_the_queue_stops_pending(job_pool, monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(jobs, "_get_executor", lambda: executor)
+    jobs.submit_job("test", slow_job, 0)
+    queued = jobs.submit_job("test", slow_job, 1)
+    # What shutdown(cancel_futures=True) does to jobs that haven't started
+    assert jobs._jobs[queued]["future"].cancel()
+    release.set()
+    executor.shutdown(wait=True)
+    job = jobs.get_job(queued)
+    assert job["status"] == jobs.FAILED and job["finished_at"] is not None
+    assert jobs._pending_count() == 0
+    assert jobs._inflight == {}
+
+
+def test_failure_reaches_every_waiter(job_pool):
+    results = asyncio.run(_submit_together(3, 7, fail=True))
+    assert calls == [7]
+    assert all(isinstance(result, ValueError) and str(result) == "bad input 7" for result in results)
+    job, = jobs._jobs.values()
+    assert job["status"] == jobs.FAILED and job["requests"] == 3
+
+
+def test_different_or_finished_jobs_run_again(job_pool):
+    release.set()
+    first = jobs.submit_job("test", slow_job, 1)
+    second = jobs.submit_job("test", slow_job, 2)
+    assert first != second
+    asyncio.run(jobs.wait_for_job(first))
+    asyncio.run(jobs.wait_for_job(second))
+    # Only unfinished jobs are joined
+    asyncio.run(jobs.run_job("test", slow_job, 1))
+    assert sorted(calls) == [1, 1, 2]
+
+
+def test_coalescing_can_be_turned_off(job_pool, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_COALESCE", False)
+    results = asyncio.run(_submit_together(3, 5))
+    assert calls == [5, 5, 5]
+    assert results == [{"value": 5}] * 3
+
+
+@pytest.fixture
+def injury_stub(monkeypatch):
+    """Replaces the download and model with a stub that records the links it gets and waits for an Event"""
+    state = {"calls": [], "fail": False}
+
+    async def predict(links):
+        state["calls"].append(list(links))
+        await state["release"].wait()
+        if state["fail"]:
+            raise RuntimeError("model failed")
+        return [f"result {link}" for link in links]
+
+    monkeypatch.setattr(controller, "_predict_injuries", predict)
+    monkeypatch.setattr(controller, "_injury_inflight", {})
+    return state
+
+
+async def _predict_together(state, *requests):
+    state["release"] = asyncio.Event()
+    waiters = [asyncio.ensure_future(controller.predict_injuries(links)) for links in requests]
+    await asyncio.sleep(0.01)
+    state["release"].set()
+    return await asyncio.gather(*waiters, return_exceptions=True)
+
+
+def test_injury_requests_share_predictions(injury_stub):
+    results = asyncio.run(_predict_together(injury_stub, ["a"], ["a", "b"], ["b", "a", "b"]))
+    assert injury_stub["calls"] == [["a"], ["b"]]
+    assert results == [["result a"], ["result a", "result b"], ["result b", "result a", "result b"]]
+    assert controller._injury_inflight == {}
+
+
+def test_injury_failure_reaches_every_request(injury_stub):
+    injury_stub["fail"] = True
+    results = asyncio.run(_predict_together(injury_stub, ["a"], ["a"]))
+    assert injury_stub["calls"] == [["a"]]
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_cancelled_injury_request_doesnt_cancel_the_others(injury_stub):
+    async def scenario():
+        injury_stub["release"] = asyncio.Event()
+        first = asyncio.ensure_future(controller.predict_injuries(["a"]))
+        second = asyncio.ensure_future(controller.predict_injuries(["a"]))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        injury_stub["release"].set()
+        return await second
+
+    assert asyncio.run(scenario()) == ["result a"]
+    assert injury_stub["calls"] == [["a"]]
@@ -0,0 +1,45 @@
+import asyncio
+import numpy as np
+from PIL import Image
+import controller
+import injury_detection
+
+
+def _write_images(tmp_path):
+    good = tmp_path / "good.png"
+    Image.fromarray(np.full((32, 48, 3), 200, dtype="uint8")).save(good)
+    truncated = tmp_path / "truncated.png"
+    truncated.write_bytes(good.read_bytes()[:60])
+    not_an_image = tmp_path / "text.png"
+    not_an_image.write_text("not an image")
+    return [str(good), str(truncated), str(not_an_image)]
+
+
+def test_undecodable_images_give_none(tmp_path):
+    good, truncated, not_an_image = injury_detection.preprocess_images(_write_images(tmp_path))
+    assert good.shape == (injury_detection.IMG_HEIGHT, injury_detection.IMG_WIDTH, 3)
+    assert truncated is None
+    assert not_an_image is None
+
+
+def test_only_decodable_images_reach_the_model(tmp_path, monkeypatch):
+    good, truncated, _ = _write_images(tmp_path)
+    sources = {"good": good, "truncated": truncated}
+    batches = []
+
+    def download(downloads):
+        for link, path in downloads:
+            if link in sources:
+                with open(sources[link], "rb") as src, open(path, "wb") as dst:
+                    dst.write(src.read())
+        return [link in sources for link, _ in downloads]
+
+    async def submit_many(arrays):
+        batches.append(len(arrays))
+        return [{"class": "abrasions"} for _ in arrays]
+
+    monkeypatch.setattr(controller, "download_s3_files", download)
+    monkeypatch.setattr(controller.injury_batcher, "submit_many", submit_many)
+    results = asyncio.run(controller._predict_injuries(["truncated", "missing", "good", "good"]))
+    assert results == [None, None, {"class": "abrasions"}, {"class": "abrasions"}]
+    assert batches == [2]
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from kinematics import (LEFT_ANKLE, LEFT_ELBOW, LEFT_HIP, LEFT_KNEE, LEFT_SHOULDER, LEFT_WRIST, RIGHT_ANKLE, RIGHT_ELBOW,
+                        RIGHT_HIP, RIGHT_KNEE, RIGHT_SHOULDER, RIGHT_WRIST, METRICS, compute_metrics)
+from scoring import align
+from timeseries import MetricSeries
+
+
+# The per-frame helpers the vectorized metrics replaced (attack_analysis.py and defence.py)
+def calculate_angle(a, b, c):
+    a = np.array(a)
+    b = np.array(b)
+    c = np.array(c)
+    radians = np.arctan2(c[1]-b[1], c[0]-b[0]) - np.arctan2(a[1]-b[1], a[0]-b[0])
+    angle = np.abs(radians*180.0/np.pi)
+    if angle > 180.0:
+        angle = 360-angle
+    return angle
+
+
+def calculate_shoulder_angle(left_shoulder, right_shoulder):
+    horizontal_point = [left_shoulder[0], right_shoulder[1]]
+    return calculate_angle(horizontal_point, right_shoulder, left_shoulder)
+
+
+def calculate_hip_knee_distance(left_hip, right_hip, left_knee, right_knee):
+    left_distance = np.sqrt((left_hip[0] - left_knee[0])**2 + (left_hip[1] - left_knee[1])**2)
+    right_distance = np.sqrt((right_hip[0] - right_knee[0])**2 + (right_hip[1] - right_knee[1])**2)
+    return (left_distance + right_distance) / 2
+
+
+def process_landmarks(landmarks):
+    """One frame's metrics as the old pipelines computed them, {} without a pose"""
+    if np.isnan(landmarks[0, 0]):
+        return {}
+    p = lambda index: landmarks[index][:2].astype(float)
+    left_hip, right_hip = p(LEFT_HIP), p(RIGHT_HIP)
+    return {
+        "shoulder_alignment": calculate_shoulder_angle(p(LEFT_SHOULDER), p(RIGHT_SHOULDER)),
+        "left_elbow": calculate_angle(p(LEFT_SHOULDER), p(LEFT_ELBOW), p(LEFT_WRIST)),
+        "right_elbow": calculate_angle(p(RIGHT_SHOULDER), p(RIGHT_ELBOW), p(RIGHT_WRIST)),
+        "left_knee": calculate_angle(left_hip, p(LEFT_KNEE), p(LEFT_ANKLE)),
+        "right_knee": calculate_angle(right_hip, p(RIGHT_KNEE), p(RIGHT_ANKLE)),
+        "hip_stance": calculate_angle(left_hip, [(left_hip[0] + right_hip[0])/2, (left_hip[1] + right_hip[1])/2], right_hip),
+        "stance_width": calculate_hip_knee_distance(left_hip, right_hip, p(LEFT_KNEE), p(RIGHT_KNEE)),
+    }
+
+
+def random_landmarks(seed, frames=60):
+    """Random (frames, 33, 4) landmarks with some frames missing a pose and a few missing single landmarks"""
+    rng = np.random.default_rng(seed)
+    landmarks = rng.uniform(0, 1, size=(frames, 33, 4)).astype(np.float32)
+    # A pose with one NaN landmark gives NaN for the metrics that use it
+    landmarks[3, LEFT_ELBOW] = np.nan
+    landmarks[5, RIGHT_KNEE, 1] = np.nan
+    # Coincident points and a straight joint (the 180 degree wrap)
+    landmarks[7, LEFT_WRIST] = landmarks[7, LEFT_ELBOW]
+    landmarks[8, [RIGHT_SHOULDER, RIGHT_ELBOW, RIGHT_WRIST], :2] = [[0.2, 0.5], [0.4, 0.5], [0.6, 0.5]]
+    # Frames without a pose are all NaN (see pose_extraction.detect_landmarks)
+    missing = rng.random(frames) < 0.2
+    missing[:10] = False
+    landmarks[missing] = np.nan
+    return landmarks
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_metrics_match_per_frame_formulas(seed):
+    landmarks = random_landmarks(seed)
+    metrics = compute_metrics(landmarks)
+    for index, frame in enumerate(landmarks):
+        expected = process_landmarks(frame)
+        for name in METRICS:
+            if expected:
+                np.testing.assert_allclose(metrics[name][index], expected[name], rtol=1e-9, atol=1e-9, equal_nan=True)
+            else:
+                assert np.isnan(metrics[name][index])
+
+
+def test_missing_landmarks_are_nan():
+    metrics = compute_metrics(random_landmarks(0))
+    assert np.isnan(metrics["left_elbow"][3]) and not np.isnan(metrics["right_elbow"][3])
+    assert np.isnan(metrics["right_knee"][5]) and np.isnan(metrics["stance_width"][5])
+    assert np.isclose(metrics["right_elbow"][8], 180.0)
+
+
+def test_series_rows_with_a_pose():
+    landmarks = random_landmarks(1)
+    series = MetricSeries.from_landmarks(landmarks, ("left_elbow", "left_knee"))
+    assert np.array_equal(series.valid, [bool(process_landmarks(frame)) for frame in landmarks])
+    detected = series.detected()
+    assert np.array_equal(detected.frames, np.flatnonzero(series.valid))
+    assert not np.isnan(detected["left_knee"]).any()
+    as_dict = series.to_dict()
+    assert all((value is None) == np.isnan(row) for value, row in zip(as_dict["left_knee"], series["left_knee"]))
+
+
+def test_frame_by_frame_pairing_matches_the_old_loop():
+    correct, incorrect = random_landmarks(2, 60), random_landmarks(3, 45)
+    names = ("shoulder_alignment", "left_elbow", "right_elbow")
+    paired_correct, paired_incorrect, alignment = align(MetricSeries.from_landmarks(correct, names),
+                                                        MetricSeries.from_landmarks(incorrect, names), names)
+    # The old pipelines kept the frames where both videos had a pose, up to the shorter clip
+    expected = [(a, b) for a, b in zip(map(process_landmarks, correct), map(process_landmarks, incorrect)) if a and b]
+    assert len(alignment) == len(expected)
+    for name in names:
+        np.testing.assert_allclose(paired_correct[name], [a[name] for a, _ in expected], equal_nan=True)
+        np.testing.assert_allclose(paired_incorrect[name], [b[name] for _, b in expected], equal_nan=True)
@@ -0,0 +1,77 @@
+import math
+import numpy as np
+import pytest
+from scoring import DTW_MAX_WINDOW, dtw
+
+
+def naive_dtw(x, y, band=None):
+    """Full cost matrix DTW, cell by cell, over the same Sakoe-Chiba band as scoring.dtw (None: no band)"""
+    n, m = len(x), len(y)
+    slope = (m - 1) / (n - 1) if n > 1 else 0
+    width = max(min(int((band or 0) * max(n, m)), DTW_MAX_WINDOW), math.ceil(slope), 1)
+    D = np.full((n, m), np.inf)
+    for i in range(n):
+        center = i * slope if n > 1 else m - 1
+        start = 0 if i == 0 or band is None else max(0, math.floor(center - width))
+        stop = m if i == n - 1 or band is None else min(m, math.ceil(center + width) + 1)
+        for j in range(start, stop):
+            cost = np.linalg.norm(x[i] - y[j])
+            if i == 0 and j == 0:
+                D[i, j] = cost
+                continue
+            previous = min(D[i - 1, j - 1] if i and j else np.inf,
+                           D[i - 1, j] if i else np.inf,
+                           D[i, j - 1] if j else np.inf)
+            D[i, j] = cost + previous
+    return D
+
+
+def check_path(x, y, path, total):
+    assert tuple(path[0]) == (0, 0)
+    assert tuple(path[-1]) == (len(x) - 1, len(y) - 1)
+    steps = np.diff(path, axis=0)
+    assert np.all((steps >= 0) & (steps <= 1)) and np.all(steps.sum(axis=1) >= 1)
+    assert np.isclose(sum(np.linalg.norm(x[i] - y[j]) for i, j in path), total)
+
+
+@pytest.mark.parametrize("n, m, band", [
+    (30, 30, 0.1),
+    (20, 35, 0.1),   # unequal lengths
+    (35, 20, 0.2),
+    (10, 40, 0.01),  # band narrower than the length difference
+    (40, 10, 0.0),
+    (1, 12, 0.1),
+    (12, 1, 0.1),
+    (1, 1, 0.1),
+    (25, 18, 1.0),   # band covering the whole matrix
+])
+def test_dtw_matches_naive_reference(n, m, band):
+    rng = np.random.default_rng(n * 100 + m)
+    for _ in range(10):
+        x, y = rng.normal(size=(n, 3)), rng.normal(size=(m, 3))
+        cost, path = dtw(x, y, band)
+        total = naive_dtw(x, y, band)[-1, -1]
+        assert np.isfinite(total)
+        assert np.isclose(cost, total / len(path))
+        check_path(x, y, path, total)
+
+
+def test_dtw_full_band_is_unconstrained():
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=(15, 2)), rng.normal(size=(22, 2))
+    cost, path = dtw(x, y, band=10.0)
+    assert np.isclose(cost * len(path), naive_dtw(x, y)[-1, -1])
+
+
+def test_dtw_identical_series_follow_the_diagonal():
+    x = np.random.default_rng(1).normal(size=(16, 4))
+    cost, path = dtw(x, x.copy())
+    assert cost == 0
+    assert np.array_equal(path, np.stack([np.arange(16)] * 2, axis=1))
+
+
+@pytest.mark.parametrize("n, m", [(0, 0), (0, 5), (5, 0)])
+def test_dtw_empty_series(n, m):
+    cost, path = dtw(np.empty((n, 3)), np.empty((m, 3)))
+    assert cost == np.inf
+    assert path.shape == (0, 2)
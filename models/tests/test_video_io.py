@@ -0,0 +1,33 @@
+import cv2
+import numpy as np
+from video_io import read_frame_pairs
+
+
+def write_video(path, count):
+    """A small video whose frame n is filled with gray level 20 * n"""
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"MJPG"), 10, (32, 24))
+    for n in range(count):
+        writer.write(np.full((24, 32, 3), 20 * n, dtype=np.uint8))
+    writer.release()
+
+
+def test_frame_pairs_can_be_drawn_on(tmp_path):
+    first, second = tmp_path / "first.avi", tmp_path / "second.avi"
+    write_video(first, 5)
+    write_video(second, 4)
+    pairs = [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (2, 3), (3, 3), (4, 3)]
+    yielded = []
+    for a, b in read_frame_pairs(str(first), str(second), pairs):
+        yielded.append((int(np.median(a)), int(np.median(b))))
+        # Annotating one pair's frames must not show up in later pairs
+        a[:] = 255
+        b[:] = 255
+    levels = [(round(a / 20), round(b / 20)) for a, b in yielded]
+    assert levels == pairs
+
+
+def test_frame_pairs_stop_at_the_shorter_video(tmp_path):
+    first, second = tmp_path / "first.avi", tmp_path / "second.avi"
+    write_video(first, 3)
+    write_video(second, 2)
+    assert len(list(read_frame_pairs(str(first), str(second), [(0, 0), (1, 1), (2, 2)]))) == 2
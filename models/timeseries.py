@@ -0,0 +1,65 @@
+import numpy as np
+from kinematics import compute_metrics, pose_mask
+
+
+class MetricSeries:
+    """
+    Per-frame metrics of one clip, backed by numpy arrays.
+
+    values is a structured array with one fixed-dtype field per metric (see
+    kinematics.compute_metrics), frames holds each row's frame number in the
+    source video and valid marks the rows where a pose was detected (their
+    values are NaN otherwise). Indexing mirrors the structured array: a metric
+    name gives that column, an integer gives one frame's row, and a slice gives
+    a MetricSeries view that shares memory with this one.
+    """
+
+    __slots__ = ("values", "valid", "frames", "fps")
+
+    def __init__(self, values, valid, frames=None, fps=30):
+        self.values = values
+        self.valid = valid
+        self.frames = np.arange(len(values)) if frames is None else frames
+        self.fps = fps
+
+    @classmethod
+    def from_landmarks(cls, landmarks, names, fps=30):
+        """Compute the named metrics for a (frames, 33, 4) landmark array"""
+        return cls(compute_metrics(landmarks, names), pose_mask(landmarks), fps=fps)
+
+    @property
+    def names(self):
+        return self.values.dtype.names
+
+    @property
+    def timestamps(self):
+        """Seconds from the start of the source video for every row"""
+        return self.frames / self.fps
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.values[key]
+        if isinstance(key, slice):
+            return MetricSeries(self.values[key], self.valid[key], self.frames[key], self.fps)
+        return self.values[key]
+
+    def to_dict(self):
+        """Plain lists for a JSON response: frame numbers, timestamps and each metric (None where NaN)"""
+        series = {"frames": self.frames.tolist(), "timestamps": self.timestamps.tolist()}
+        for name in self.names:
+            series[name] = [None if np.isnan(value) else value for value in self.values[name].tolist()]
+        return series
+
+    def select(self, mask):
+        """The rows where mask is True (a copy, as with any boolean indexing)"""
+        return MetricSeries(self.values[mask], self.valid[mask], self.frames[mask], self.fps)
+
+    def detected(self):
+        """The rows of frames with a detected pose"""
+        return self.select(self.valid)
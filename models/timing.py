@@ -0,0 +1,111 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds (seconds) of the latency histogram buckets kept for every stage,
+# from a single frame's pose inference up to a whole job
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Timings:
+    """
+    Time spent in named stages (decode, pose, angles, graph, annotate,
+    composite, encode, upload, download, inference, ...) with the number of
+    calls and a histogram of their durations over BUCKETS, plus counts of
+    named events (such as cache hits). Names may be any hashable, e.g. a
+    tuple of labels.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, name):
+        entry = self.stages.get(name)
+        if entry is None:
+            entry = self.stages[name] = {"seconds": 0.0, "calls": 0, "buckets": [0] * (len(BUCKETS) + 1)}
+        return entry
+
+    def add(self, name, seconds):
+        with self.lock:
+            entry = self._entry(name)
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            entry["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.events[name] = self.events.get(name, 0) + value
+
+    def merge(self, summary):
+        """Add the totals of another Timings' summary() (e.g. from a worker process)"""
+        with self.lock:
+            for name, other in summary["stages"].items():
+                entry = self._entry(name)
+                entry["seconds"] += other["seconds"]
+                entry["calls"] += other["calls"]
+                entry["buckets"] = [a + b for a, b in zip(entry["buckets"], other["buckets"])]
+            for name, value in summary["events"].items():
+                self.events[name] = self.events.get(name, 0) + value
+
+    def summary(self):
+        """A plain copy that can be pickled across processes"""
+        with self.lock:
+            return {"stages": {name: {**entry, "buckets": list(entry["buckets"])} for name, entry in self.stages.items()},
+                    "events": dict(self.events)}
+
+
+def breakdown(summary):
+    """A Timings summary without the histograms, as returned to API clients"""
+    return {"stages": {name: {"seconds": round(entry["seconds"], 4), "calls": entry["calls"]}
+                       for name, entry in sorted(summary["stages"].items())},
+            "events": summary["events"]}
+
+
+# Everything this process has timed since it started (read by metrics.py in
+# the API process), and the recorder of the job it is running, if any
+process_timings = Timings()
+_recorder = None
+
+
+@contextmanager
+def stage(name):
+    """Time the block as stage `name`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        process_timings.add(name, elapsed)
+        recorder = _recorder
+        if recorder is not None:
+            recorder.add(name, elapsed)
+
+
+def count(name, value=1):
+    """Count an event, such as a cache hit"""
+    process_timings.count(name, value)
+    recorder = _recorder
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+@contextmanager
+def record_stages():
+    """
+    Collect the stage() timings and events of every thread in this process
+    while the block runs, into the Timings it yields. This is per process, so
+    it suits a job worker running one job at a time. Stages that run in
+    parallel threads (pose for both videos, upload parts) are summed, so the
+    total can exceed the wall time.
+    """
+    global _recorder
+    previous = _recorder
+    _recorder = Timings()
+    try:
+        yield _recorder
+    finally:
+        _recorder = previous
@@ -0,0 +1,246 @@
+import os
+import cv2
+import numpy as np
+from errors import TrackNotFound
+from pose_cache import cache_key, file_hash, landmark_cache
+from timing import stage
+from video_io import read_frames
+
+
+# Multi-person mode: players are found by a person detector that only runs on
+# every TRACK_DETECT_INTERVAL-th frame, linked into tracks with stable ids and
+# interpolated in between. Pose then runs on the selected track only, in a
+# region around it (see pose_extraction.detect_landmarks), so the cost per
+# frame doesn't grow with the number of players on court.
+# hog (OpenCV's built-in people detector) or mediapipe (an EfficientDet-Lite
+# object detector model at PERSON_DETECTOR_MODEL), see PERSON_DETECTORS
+PERSON_DETECTOR = os.environ.get("PERSON_DETECTOR", "hog")
+PERSON_DETECTOR_MODEL = os.environ.get("PERSON_DETECTOR_MODEL")
+TRACK_DETECT_INTERVAL = int(os.environ.get("TRACK_DETECT_INTERVAL", 5))
+# Frames are downscaled so their longer side is at most this before detection
+TRACK_MAX_SIDE = int(os.environ.get("TRACK_MAX_SIDE", 800))
+# Minimum overlap of a detection with a track's predicted box to continue it
+TRACK_IOU_THRESHOLD = float(os.environ.get("TRACK_IOU_THRESHOLD", 0.2))
+# Detections in a row a track may miss (occlusion, a missed detection) before it ends
+TRACK_MAX_MISSES = int(os.environ.get("TRACK_MAX_MISSES", 3))
+# Tracks detected fewer times than this are dropped as false positives
+TRACK_MIN_DETECTIONS = int(os.environ.get("TRACK_MIN_DETECTIONS", 2))
+
+
+class HOGPersonDetector:
+    """OpenCV's HOG + linear SVM people detector, which needs no model download"""
+
+    def __init__(self, min_score=0.5):
+        self.min_score = min_score
+        self.hog = cv2.HOGDescriptor()
+        self.hog.setSVMDetector(cv2.HOGDescriptor_getDefaultPeopleDetector())
+
+    def detect(self, frame):
+        rects, weights = self.hog.detectMultiScale(frame, winStride=(8, 8), padding=(8, 8), scale=1.05)
+        if len(rects) == 0:
+            return np.empty((0, 4)), np.empty(0)
+        rects, weights = np.asarray(rects, dtype=np.float64), np.asarray(weights, dtype=np.float64).ravel()
+        keep = cv2.dnn.NMSBoxes(rects.tolist(), weights.tolist(), self.min_score, 0.4)
+        keep = np.asarray(keep, dtype=int).ravel()
+        boxes, weights = np.column_stack([rects[keep, :2], rects[keep, :2] + rects[keep, 2:]]), weights[keep]
+        # HOG also fires on parts of a person (upper body, legs): drop boxes
+        # that lie mostly inside a higher scoring one (NMSBoxes sorts by score)
+        kept = []
+        for index, box in enumerate(boxes):
+            area = np.prod(box[2:] - box[:2])
+            inside = [np.prod(np.clip(np.minimum(box[2:], boxes[k, 2:]) - np.maximum(box[:2], boxes[k, :2]), 0, None)) / area
+                      for k in kept]
+            if not inside or max(inside) < 0.6:
+                kept.append(index)
+        return boxes[kept], weights[kept]
+
+    def close(self):
+        pass
+
+
+class MediaPipePersonDetector:
+    """MediaPipe's object detector with an EfficientDet-Lite model, keeping people only"""
+
+    def __init__(self, min_score=0.4, model_path=PERSON_DETECTOR_MODEL):
+        import mediapipe as mp
+        if not model_path:
+            raise ValueError("PERSON_DETECTOR_MODEL must point to an object detector model for the mediapipe person detector")
+        self.mp = mp
+        options = mp.tasks.vision.ObjectDetectorOptions(
+            base_options=mp.tasks.BaseOptions(model_asset_path=model_path),
+            running_mode=mp.tasks.vision.RunningMode.IMAGE,
+            score_threshold=min_score, category_allowlist=["person"])
+        self.detector = mp.tasks.vision.ObjectDetector.create_from_options(options)
+
+    def detect(self, frame):
+        image = self.mp.Image(image_format=self.mp.ImageFormat.SRGB, data=cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        detections = self.detector.detect(image).detections
+        boxes = [(d.bounding_box.origin_x, d.bounding_box.origin_y,
+                  d.bounding_box.origin_x + d.bounding_box.width, d.bounding_box.origin_y + d.bounding_box.height)
+                 for d in detections]
+        return np.array(boxes, dtype=np.float64).reshape(-1, 4), np.array([d.categories[0].score for d in detections])
+
+    def close(self):
+        self.detector.close()
+
+
+PERSON_DETECTORS = {"hog": HOGPersonDetector, "mediapipe": MediaPipePersonDetector}
+
+
+def tracking_settings():
+    """Everything the tracks of a video depend on, part of their cache keys"""
+    return {"detector": PERSON_DETECTOR, "model": os.path.basename(PERSON_DETECTOR_MODEL or "") or None,
+            "interval": TRACK_DETECT_INTERVAL, "max_side": TRACK_MAX_SIDE, "iou": TRACK_IOU_THRESHOLD,
+            "max_misses": TRACK_MAX_MISSES, "min_detections": TRACK_MIN_DETECTIONS}
+
+
+def box_iou(boxes, others):
+    """IoU of every box in boxes (n, 4) with every box in others (m, 4), as (x1, y1, x2, y2)"""
+    top_left = np.maximum(boxes[:, None, :2], others[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], others[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    other_area = np.prod(others[:, 2:] - others[:, :2], axis=1)
+    return intersection / np.maximum(area[:, None] + other_area[None, :] - intersection, 1e-9)
+
+
+class PersonTracker:
+    """
+    Links the detections of successive detection frames into tracks. Each
+    track's box is predicted forward at its last velocity and detections are
+    matched greedily by IoU with the prediction or, when better (after one
+    bad box threw the velocity off), with the last box. Unmatched detections
+    start new tracks, whose ids count up from 0 in order of appearance.
+    """
+
+    def __init__(self, iou_threshold=TRACK_IOU_THRESHOLD, max_misses=TRACK_MAX_MISSES):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.tracks = []
+
+    def update(self, boxes):
+        """Match one detection frame's boxes; returns the track id of each box"""
+        active = [track for track in self.tracks if track["misses"] <= self.max_misses]
+        ious = np.empty((len(active), len(boxes)))
+        if len(active) and len(boxes):
+            last = np.array([track["box"] for track in active])
+            predicted = np.array([track["box"] + track["velocity"] * (track["misses"] + 1) for track in active])
+            ious = np.maximum(box_iou(predicted, boxes), box_iou(last, boxes))
+
+        ids = [None] * len(boxes)
+        matched = set()
+        for flat in np.argsort(-ious, axis=None):
+            t, b = np.unravel_index(flat, ious.shape)
+            if ious[t, b] < self.iou_threshold:
+                break
+            if t in matched or ids[b] is not None:
+                continue
+            track = active[t]
+            track["velocity"] = (boxes[b] - track["box"]) / (track["misses"] + 1)
+            track["box"] = boxes[b]
+            track["misses"] = 0
+            ids[b] = track["id"]
+            matched.add(t)
+
+        for t, track in enumerate(active):
+            if t not in matched:
+                track["misses"] += 1
+        for b, box in enumerate(boxes):
+            if ids[b] is None:
+                ids[b] = len(self.tracks)
+                self.tracks.append({"id": ids[b], "box": box, "velocity": np.zeros(4), "misses": 0})
+        return ids
+
+
+def track_people(frames, detector, interval=TRACK_DETECT_INTERVAL, max_side=TRACK_MAX_SIDE):
+    """
+    Track the people in BGR frames. Returns a (frames, tracks, 4) array of
+    each track's box (x1, y1, x2, y2, normalized to 0-1) in each frame, NaN
+    where the track isn't present. Boxes are detected every interval-th frame,
+    interpolated between detections and held for the frames after a track's
+    last one until the next detection frame.
+    """
+    tracker = PersonTracker()
+    detections = {}
+    count = 0
+    for index, frame in enumerate(frames):
+        count += 1
+        if index % interval:
+            continue
+        height, width = frame.shape[:2]
+        scale = min(1.0, max_side / max(height, width))
+        with stage("detect"):
+            image = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else frame
+            boxes, _ = detector.detect(image)
+        boxes = boxes / [image.shape[1], image.shape[0], image.shape[1], image.shape[0]]
+        for track_id, box in zip(tracker.update(boxes), boxes):
+            detections.setdefault(track_id, {})[index] = box
+
+    # Tracks found only once or twice are usually false positives; the rest keep their order
+    kept = [track_id for track_id in sorted(detections) if len(detections[track_id]) >= TRACK_MIN_DETECTIONS]
+    tracks = np.full((count, len(kept), 4), np.nan, dtype=np.float32)
+    for column, track_id in enumerate(kept):
+        frames_seen = np.array(sorted(detections[track_id]))
+        boxes = np.array([detections[track_id][index] for index in frames_seen])
+        span = np.arange(frames_seen[0], frames_seen[-1] + 1)
+        tracks[span, column] = np.stack([np.interp(span, frames_seen, boxes[:, k]) for k in range(4)], axis=1)
+        hold = np.arange(frames_seen[-1] + 1, min(frames_seen[-1] + interval, count))
+        tracks[hold, column] = boxes[-1]
+    return tracks
+
+
+def person_tracks(video_path, content_hash=None):
+    """
+    The tracks of a video (see track_people), cached by its content hash so
+    listing a video's tracks and analysing one of them detect people once.
+    Pass content_hash when the caller already has it, to skip hashing the file.
+    """
+    key = cache_key(content_hash or file_hash(video_path), {"tracks": tracking_settings()})
+    tracks = landmark_cache.get(key)
+    if tracks is not None:
+        return tracks
+
+    detector = PERSON_DETECTORS[PERSON_DETECTOR]()
+    try:
+        tracks = track_people(read_frames(video_path), detector)
+    finally:
+        detector.close()
+    landmark_cache.put(key, tracks)
+    return tracks
+
+
+def track_summary(tracks):
+    """Where and when each track appears, for choosing one to analyse"""
+    summary = []
+    for track_id in range(tracks.shape[1]):
+        present = np.flatnonzero(~np.isnan(tracks[:, track_id, 0]))
+        summary.append({
+            "track": track_id,
+            "first_frame": int(present[0]),
+            "last_frame": int(present[-1]),
+            "frames": len(present),
+            # Median box over the frames it appears in, (x1, y1, x2, y2) normalized to the frame
+            "box": [round(float(value), 4) for value in np.median(tracks[present, track_id], axis=0)],
+        })
+    return summary
+
+
+def main_track(tracks):
+    """The track present in the most frames (the larger on average when tied), or None"""
+    if tracks.shape[1] == 0:
+        return None
+    present = np.sum(~np.isnan(tracks[:, :, 0]), axis=0)
+    area = np.nanmean(np.prod(tracks[:, :, 2:] - tracks[:, :, :2], axis=2), axis=0)
+    return int(max(range(tracks.shape[1]), key=lambda track_id: (present[track_id], area[track_id])))
+
+
+def resolve_track(video_path, track=None, content_hash=None):
+    """The id of track in a video's tracks, or of its main track when track is None"""
+    tracks = person_tracks(video_path, content_hash)
+    if track is None:
+        track = main_track(tracks)
+        if track is None:
+            raise TrackNotFound("no people were found in the video")
+    elif not 0 <= track < tracks.shape[1]:
+        raise TrackNotFound(f"track {track} not found, the video has {tracks.shape[1]} tracks")
+    return track
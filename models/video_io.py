@@ -0,0 +1,309 @@
+import queue
+import struct
+import subprocess
+import tempfile
+import threading
+import cv2
+import numpy as np
+from moviepy.config import get_setting
+from timing import stage
+
+
+OUTPUT_SIZE = (1280, 720)
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+def get_video_properties(video_path):
+    """Return (width, height, fps) of a video file"""
+    cap = cv2.VideoCapture(video_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = int(cap.get(cv2.CAP_PROP_FPS)) or 30
+    cap.release()
+    return width, height, fps
+
+
+def read_frames(video_path):
+    """Yield the BGR frames of a video one at a time"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        while cap.isOpened():
+            with stage("decode"):
+                ret, frame = cap.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+
+def read_frame_pairs(first_path, second_path, pairs):
+    """
+    Yield (first frame, second frame) for each (i, j) pair of frame numbers.
+    Pairs must be non-decreasing in both videos (like a DTW alignment path), so
+    each video is still decoded once from start to end. Yielded frames belong
+    to the caller, who may draw on them: a frame that appears in several
+    consecutive pairs is yielded as a copy of the decoded frame for all but
+    the last of them, which gets the decoded frame itself.
+    """
+    readers = [read_frames(first_path), read_frames(second_path)]
+    positions = [-1, -1]
+    current = [None, None]
+    pairs = iter(pairs)
+    pair = next(pairs, None)
+    while pair is not None:
+        upcoming = next(pairs, None)
+        frames = []
+        for k, index in enumerate(pair):
+            while positions[k] < index:
+                current[k] = next(readers[k], None)
+                positions[k] += 1
+            # Keep the decoded frame untouched while the next pair still needs it
+            reused = upcoming is not None and upcoming[k] <= positions[k]
+            frames.append(current[k].copy() if reused and current[k] is not None else current[k])
+        if frames[0] is None or frames[1] is None:
+            return
+        yield frames[0], frames[1]
+        pair = upcoming
+
+
+def resize_to_height(frame, height):
+    """Resize a frame to the given height, preserving its aspect ratio"""
+    h, w = frame.shape[:2]
+    if h == height:
+        return frame
+    width = max(1, round(w * height / h))
+    return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def fit_to_canvas(frame, size=OUTPUT_SIZE, color=BACKGROUND_COLOR):
+    """Scale a frame to fit within size and center it on a solid background"""
+    target_w, target_h = size
+    h, w = frame.shape[:2]
+    scale = min(target_w / w, target_h / h)
+    new_w, new_h = int(w * scale), int(h * scale)
+
+    canvas = np.empty((target_h, target_w, 3), dtype=np.uint8)
+    canvas[:] = color
+    x = (target_w - new_w) // 2
+    y = (target_h - new_h) // 2
+    canvas[y:y + new_h, x:x + new_w] = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    return canvas
+
+
+def compose_with_graph(video_frame, graph_frame, size=OUTPUT_SIZE):
+    """Place a graph frame to the right of a video frame and fit the result on the output canvas"""
+    with stage("composite"):
+        if graph_frame is None:
+            graph_frame = np.full_like(video_frame[:, :1], 255)
+        graph_frame = resize_to_height(graph_frame, video_frame.shape[0])
+        return fit_to_canvas(np.hstack((video_frame, graph_frame)), size)
+
+
+class VideoEncoder:
+    """
+    Encode BGR frames with a single ffmpeg process fed through a pipe,
+    so frames never have to be written to disk as images first.
+
+    output is a file path, or any object with a write() method (such as
+    storage.MultipartUpload), which then receives the video as it is encoded.
+    Streamed output is a fragmented MP4, since a regular MP4's index can only
+    be written once the whole video is known.
+    """
+
+    def __init__(self, output, size, fps, codec="libx264", preset="medium", crf=None, threads=None):
+        self.output = output
+        self.output_path = output if isinstance(output, str) else "stream"
+        self.size = size
+        width, height = size
+        cmd = [
+            get_setting("FFMPEG_BINARY"),
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo",
+            "-vcodec", "rawvideo",
+            "-s", f"{width}x{height}",
+            "-pix_fmt", "bgr24",
+            "-r", f"{fps:.02f}",
+            "-an", "-i", "-",
+            "-vcodec", codec,
+            "-preset", preset,
+            "-pix_fmt", "yuv420p",
+        ]
+        if crf is not None:
+            cmd += ["-crf", str(crf)]
+        if threads is not None:
+            cmd += ["-threads", str(threads)]
+        self.pump = None
+        self.pump_error = None
+        if isinstance(output, str):
+            cmd.append(output)
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        else:
+            # A new fragment at least every second, so the output flows steadily
+            cmd += ["-movflags", "frag_keyframe+empty_moov+default_base_moof", "-frag_duration", "1000000",
+                    "-f", "mp4", "pipe:1"]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.pump = threading.Thread(target=self._pump, daemon=True)
+            self.pump.start()
+        self.frame_count = 0
+
+    def _pump(self):
+        """Pass ffmpeg's output on to the output object as it comes out"""
+        # read1 hands over whatever ffmpeg has written so far instead of waiting for a full chunk
+        for chunk in iter(lambda: self.proc.stdout.read1(1024 * 1024), b""):
+            if self.pump_error is not None:
+                continue  # keep draining so ffmpeg never blocks on a full pipe
+            try:
+                self.output.write(chunk)
+            except Exception as e:
+                self.pump_error = e
+
+    @classmethod
+    def from_settings(cls, output_path, fps, settings):
+        """Encoder for encoding.encoder_settings()"""
+        return cls(output_path, settings["size"], fps, preset=settings["preset"], crf=settings["crf"], threads=settings["threads"])
+
+    def write(self, frame):
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            raise ValueError(f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match encoder size {self.size[0]}x{self.size[1]}")
+        try:
+            # Writing blocks while ffmpeg is busy, so this is the time spent waiting on the encoder
+            with stage("encode"):
+                self.proc.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            raise IOError(f"ffmpeg stopped accepting frames: {self.proc.stderr.read().decode(errors='replace')}")
+        self.frame_count += 1
+
+    def close(self):
+        with stage("encode"):
+            self.proc.stdin.close()
+            error = self.proc.stderr.read().decode(errors="replace")
+            if self.pump is not None:
+                self.pump.join()
+        if self.proc.wait() != 0:
+            raise IOError(f"ffmpeg failed to encode {self.output_path}: {error}")
+        if self.pump_error is not None:
+            raise self.pump_error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.proc.kill()
+            self.proc.wait()
+            if self.pump is not None:
+                self.pump.join()
+
+
+def is_streamable_mp4(header):
+    """
+    Whether an MP4/MOV can be decoded while it is still downloading, judged from
+    its first bytes: True when the moov box comes before the media data (a
+    "faststart" or fragmented file), False when mdat comes first or the file is
+    not an MP4, None when more bytes are needed to tell.
+    """
+    offset = 0
+    while offset + 8 <= len(header):
+        size, box = struct.unpack(">I4s", header[offset:offset + 8])
+        if offset == 0 and box != b"ftyp":
+            return False
+        if box in (b"moov", b"moof"):
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1:
+            if offset + 16 > len(header):
+                return None
+            size = struct.unpack(">Q", header[offset + 8:offset + 16])[0]
+        if size < 8:
+            # size 0 means the box runs to the end of the file
+            return False
+        offset += size
+    return None
+
+
+class StreamingDecoder:
+    """
+    Decode a video whose bytes arrive incrementally (e.g. from a download)
+    with a single ffmpeg process reading from a pipe. Bytes are passed in with
+    feed() and BGR frames come out of frames() as soon as ffmpeg decodes them.
+
+    Fed bytes are queued and written to ffmpeg from a separate thread, so a
+    slow consumer of frames never stalls the producer of bytes.
+    """
+
+    def __init__(self):
+        cmd = [
+            get_setting("FFMPEG_BINARY"),
+            "-loglevel", "error",
+            "-i", "-",
+            "-map", "0:v:0",
+            "-vsync", "passthrough",
+            # PPM frames carry their own size, which isn't known before decoding starts
+            "-f", "image2pipe",
+            "-vcodec", "ppm",
+            "-",
+        ]
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr)
+        self.chunks = queue.Queue()
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _feed(self):
+        try:
+            while True:
+                chunk = self.chunks.get()
+                if chunk is None:
+                    break
+                self.proc.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+
+    def feed(self, chunk):
+        self.chunks.put(chunk)
+
+    def finish(self):
+        """Signal that all bytes have been fed"""
+        self.chunks.put(None)
+
+    def frames(self):
+        """Yield decoded BGR frames until the stream ends"""
+        stdout = self.proc.stdout
+        while stdout.readline().strip() == b"P6":
+            width, height = map(int, stdout.readline().split())
+            stdout.readline()  # maxval, always 255 for 8-bit video
+            frame_size = width * height * 3
+            data = stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            rgb = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+            yield cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+    def close(self):
+        """Wait for ffmpeg to exit and raise IOError if decoding failed"""
+        self.feeder.join()
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        self.stderr.seek(0)
+        error = self.stderr.read().decode(errors="replace")
+        self.stderr.close()
+        if returncode != 0:
+            raise IOError(f"ffmpeg failed to decode stream: {error}")
+
+    def kill(self):
+        self.proc.kill()
+        self.finish()
+        self.feeder.join()
+        self.proc.stdout.close()
+        self.proc.wait()
+        self.stderr.close()
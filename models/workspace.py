@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+
+
+# Where per-job scratch directories are created. When WORKSPACE_USE_TMPFS is
+# enabled and /dev/shm exists, scratch files live in RAM instead (remember to
+# give the container enough shared memory, e.g. `docker run --shm-size=2g`).
+WORKSPACE_ROOT = os.environ.get("WORKSPACE_ROOT")
+WORKSPACE_USE_TMPFS = os.environ.get("WORKSPACE_USE_TMPFS", "false").lower() == "true"
+TMPFS_PATH = "/dev/shm"
+
+
+def default_root():
+    if WORKSPACE_ROOT:
+        return WORKSPACE_ROOT
+    if WORKSPACE_USE_TMPFS and os.path.isdir(TMPFS_PATH):
+        return TMPFS_PATH
+    return tempfile.gettempdir()
+
+
+class Workspace:
+    """
+    Private scratch directory for a single analysis job.
+    Everything the job writes lives under one unique directory that is removed
+    when the context exits, so concurrent jobs never see each other's files.
+    """
+
+    def __init__(self, name="job", root=None):
+        self.name = name
+        self.root = root or default_root()
+        self.dir = None
+
+    def __enter__(self):
+        os.makedirs(self.root, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix=f"netball_{self.name}_", dir=self.root)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def path(self, *parts):
+        """Return a path inside the workspace, creating parent directories"""
+        path = os.path.join(self.dir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def subdir(self, *parts):
+        """Return a directory inside the workspace, creating it if needed"""
+        path = os.path.join(self.dir, *parts)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def cleanup(self):
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+